@@ -28,9 +28,42 @@ function parseLynx(r) {
     // MessagePack
     if(r.headers.get("Content-Type") == "lynx/msgpack") {
         return MessagePack.decodeAsync(r.body)
+        .then(data => decodeLynxV2(data))
     }
 }
 
+const lynxV2Magic = "\u0000lynx"
+
+function decodeLynxV2(data) {
+    // Lynx v2 stores dicts with the same keys as arrays against a schema and repeated strings in a string table
+    // Format is [magic, 2, {schemas, strings}, body] (see write_min in sdk/common.py). Returns v1 data as is
+    if(!Array.isArray(data) || data.length != 4 || data[0] != lynxV2Magic) {
+        return data
+    }
+
+    let schemas = data[2].schemas
+    let strings = data[2].strings
+
+    let extensionCodec = new MessagePack.ExtensionCodec()
+    extensionCodec.register({
+        type: 1, // Record
+        encode: () => null,
+        decode: (buf) => {
+            let values = MessagePack.decode(buf, {extensionCodec: extensionCodec})
+            let obj = {}
+            schemas[values[0]].forEach((key, i) => obj[key] = values[i + 1])
+            return obj
+        }
+    })
+    extensionCodec.register({
+        type: 2, // String table index
+        encode: () => null,
+        decode: (buf) => strings[MessagePack.decode(buf)]
+    })
+
+    return MessagePack.decode(data[3], {extensionCodec: extensionCodec})
+}
+
 
 function getToc() {
     fetch("/data/keystone/html-grades_list.lynx?d=1")
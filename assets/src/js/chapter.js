@@ -1,4 +1,5 @@
 resourceTypeData = {}
+chapterBundle = null // Info, resource types and all resources of the chapter in one file
 alreadyRendered = {}
 ranExplore = false
 // Base Info (so we dont need huge function args)
@@ -153,8 +154,7 @@ function topicEventListener(body, topic, topicData, subtopic) {
     }
     isRendered = topicAlreadyRendered(topic, subtopic)
     setTimeout(() => {
-        fetch(`/data/grades/${baseInfo.grade}/${baseInfo.board}/${baseInfo.subject}/${baseInfo.chapter}/resources-${topic}-${subtopic}.lynx`)
-        .then(r => parseLynx(r))
+        getResources(topic, subtopic)
         .then(r => {
             if(isRendered) {
                 return r
@@ -267,10 +267,29 @@ function _render(r, key, value) {
     alreadyRendered[`_${key}-card`] = true
 }
 
+function chapterPath() {
+    return `/data/grades/${baseInfo.grade}/${baseInfo.board}/${baseInfo.subject}/${baseInfo.chapter}`
+}
+
+function getChapterInfo() {
+    if(chapterBundle) {
+        return Promise.resolve(chapterBundle.info)
+    }
+    return fetch(`${chapterPath()}/info.lynx`)
+    .then(r => parseLynx(r))
+}
+
+function getResources(topic, subtopic) {
+    if(chapterBundle && chapterBundle.resources[`${topic}-${subtopic}`]) {
+        return Promise.resolve(chapterBundle.resources[`${topic}-${subtopic}`])
+    }
+    return fetch(`${chapterPath()}/resources-${topic}-${subtopic}.lynx`)
+    .then(r => parseLynx(r))
+}
+
 function renderTopic() {
     $("#toc").append(baseAccordian("chapter-accordian"))
-    fetch(`/data/grades/${baseInfo.grade}/${baseInfo.board}/${baseInfo.subject}/${baseInfo.chapter}/info.lynx`)
-    .then(r => parseLynx(r))
+    getChapterInfo()
     .then(r => {
         ranExplore = false
         Object.entries(r.topics).forEach(function([key, value]) {
@@ -315,9 +334,22 @@ function chapterPane() {
 
     document.title = `Grade ${grade} ${board.toUpperCase()} - ${subject} - Chapter ${chapter}`
 
-    fetch("/data/keystone/resource_types.lynx")
+    fetch(`${chapterPath()}/bundle.lynx`)
     .then(r => parseLynx(r))
-    .then(r => resourceTypeData = r)
+    .then(r => {
+        if(!r) {
+            throw new Error("No chapter bundle")
+        }
+        chapterBundle = r
+        resourceTypeData = r.resource_types
+    })
+    .catch(() => {
+        // Builds without bundles, fetch everything separately
+        chapterBundle = null
+        return fetch("/data/keystone/resource_types.lynx")
+        .then(r => parseLynx(r))
+        .then(r => resourceTypeData = r)
+    })
     .then(() => renderTopic())
     .catch(() => $("#toc").html("Something went wrong... Check your internet connection?"))
 }
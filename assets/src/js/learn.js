@@ -1,6 +1,33 @@
-function fetchSubjectHTML(grade, board) {
-    fetch(`/data/grades/${grade}/html-subject_base_accordian.lynx?d=1`)
+learnBundle = null // Subject HTML and all chapter lists of the grade in one file
+
+function getSubjectHTML(grade) {
+    return fetch(`/data/grades/${grade}/learn_bundle.lynx`)
     .then(r => parseLynx(r))
+    .then(r => {
+        if(!r) {
+            throw new Error("No learn bundle")
+        }
+        learnBundle = r
+        return r.html
+    })
+    .catch(() => {
+        // Builds without bundles, fetch everything separately
+        learnBundle = null
+        return fetch(`/data/grades/${grade}/html-subject_base_accordian.lynx?d=1`)
+        .then(r => parseLynx(r))
+    })
+}
+
+function getChapterList(grade, board, subject) {
+    if(learnBundle && learnBundle.chapter_lists[board] && learnBundle.chapter_lists[board][subject]) {
+        return Promise.resolve(learnBundle.chapter_lists[board][subject])
+    }
+    return fetch(`/data/grades/${grade}/${board}/${subject}/chapter_list.lynx`)
+    .then(r => parseLynx(r))
+}
+
+function fetchSubjectHTML(grade, board) {
+    getSubjectHTML(grade)
     .then(r => $("#toc").html(r[lang]))
     .then(() => {
         waitForElm(".subject-collapse")
@@ -13,8 +40,7 @@ function fetchSubjectHTML(grade, board) {
                 if(!body.attr("loaded-topics")) {
                     body.html("Loading topics")
                     setTimeout(() => {
-                        fetch(`/data/grades/${grade}/${board}/${subject}/chapter_list.lynx`)
-                        .then(r => parseLynx(r))
+                        getChapterList(grade, board, subject)
                         .then(r => {
                             if(r == undefined) {
                                 body.html("Huh? No topics found?")
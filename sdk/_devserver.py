@@ -6,11 +6,12 @@ if not os.environ.get("_DEV"):
     sys.exit(-1)
 
 sys.pycache_prefix = "data/pycache"
-sys.path.append(".")
-
-from sdk import internal
-import uvicorn    
+# Absolute as worker processes of sharded builds are started from inside data
+sys.path.append(os.path.abspath("."))
 
 
 if __name__ == "__main__":
+    # Not imported at the top as spawned worker processes run this file again
+    from sdk import internal
+    import uvicorn
     uvicorn.run(internal.internal_site.app, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""Timings and counters of a data build (see gen_info)"""
+from collections import defaultdict
+from contextlib import contextmanager
+from sdk import common
+import pathlib
+import time
+
+class BuildProfiler():
+    """
+    Times each phase of a build and counts queries, rows and bytes written
+
+    Phases of concurrently built subjects overlap so phase totals can add up to more than the wall time
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.chapters = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def add_chapter(self, key: str, seconds: float):
+        self.chapters[key] = seconds
+
+    def write_min(self, d, path, no_debug: bool = False, version: int = 1):
+        """common.write_min that is timed and counted"""
+        path = pathlib.Path(path)
+        with self.phase("write"):
+            with path.open("wb") as fp:
+                common.write_min(d, fp, no_debug=no_debug, version=version)
+
+        self.count("files_written")
+        self.count("bytes_written", path.with_suffix(".lynx").stat().st_size)
+        if not no_debug:
+            self.count("files_written")
+            self.count("bytes_written", path.with_suffix(".snowfall").stat().st_size)
+
+    def merge(self, other: dict):
+        """Adds in the report of another profiler (such as the one of a shard)"""
+        for name, seconds in other["phases"].items():
+            self.phases[name] += seconds
+        for name, n in other["counters"].items():
+            self.counters[name] += n
+        self.chapters |= other["chapters"]
+
+    def report(self) -> dict:
+        return {
+            "total_seconds": time.perf_counter() - self.start,
+            "phases": dict(self.phases),
+            "counters": dict(self.counters),
+            "chapters": dict(sorted(self.chapters.items(), key=lambda x: x[1], reverse=True))
+        }
+
+    def summary(self, slowest: int = 10) -> str:
+        report = self.report()
+        lines = [f"Build took {report['total_seconds']:.2f}s"]
+        for name, seconds in sorted(report["phases"].items(), key=lambda x: x[1], reverse=True):
+            lines.append(f"    {name}: {seconds:.2f}s")
+        for name, n in report["counters"].items():
+            lines.append(f"    {name}: {n}")
+        if report["chapters"]:
+            lines.append("Slowest chapters:")
+            for key, seconds in list(report["chapters"].items())[:slowest]:
+                lines.append(f"    {key}: {seconds:.2f}s")
+        return "\n".join(lines)
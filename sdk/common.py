@@ -1,4 +1,6 @@
-from typing import List
+from typing import Dict, List, Optional
+from collections import Counter, OrderedDict
+from copy import deepcopy
 from ruamel.yaml import YAML, comments
 import json
 import sys
@@ -9,6 +11,7 @@ import threading
 from aenum import Enum, IntEnum
 import msgpack
 import pathlib
+import hashlib
 
 debug_mode = os.environ.get("DEBUG", "0").lower() in ["1", "true"]
 
@@ -39,7 +42,7 @@ def get_subject_name(grade, subject):
         subject = subject.value.lower()
     except Exception:
         subject = subject.lower()
-    subjects = load_yaml("data/core/subjects.yaml")
+    subjects = load_core("subjects")
     if grade < 9:
         subject = subjects[subject].get("alias", subject)
     return subject
@@ -48,32 +51,78 @@ def get_subject_name(grade, subject):
 ResourceList = Enum('ResourceList', {res.name: res.name.replace("_", " ").title() for res in list(Resource)})
 
 class YamlLoadCache():
-    def __init__(self):
-        self.cache = {}
+    """
+    LRU cache of loaded YAML files
+    
+    Entries are checked against the mtime, size and inode of the file so edits made outside 
+    the process (like a git pull) are noticed. Copies are returned so callers can mutate them
+    """
+    def __init__(self, max_size: int = 256):
+        self.cache: OrderedDict = OrderedDict()
+        self.max_size = max_size
+        self.lock = threading.Lock()
 
     def clear(self):
-        self.cache = {}
+        with self.lock:
+            self.cache = OrderedDict()
 
     def _cache_key(self, filename: str, ruamel_type: str = "safe"):
-        return f"{filename}-{ruamel_type}"
+        return (os.path.abspath(filename), ruamel_type)
+
+    @staticmethod
+    def stat(filename: str) -> Optional[tuple]:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
 
-    def get(self, filename: str, ruamel_type: str = "safe"):
-        return self.cache.get(self._cache_key(filename, ruamel_type))
+    def get(self, filename: str, ruamel_type: str = "safe", copy: bool = True):
+        """If copy is False, the cached data itself is returned and must not be mutated"""
+        key = self._cache_key(filename, ruamel_type)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] != self.stat(filename):
+                del self.cache[key]
+                return None
+            self.cache.move_to_end(key)
+            data = entry[1]
+        return deepcopy(data) if copy else data
+    
+    def set(self, filename: str, data: object, ruamel_type: str = "safe", stat: tuple = None):
+        """stat should be taken before the file was read so a write during the read is not missed"""
+        stat = stat or self.stat(filename)
+        if stat is None:
+            return
+        key = self._cache_key(filename, ruamel_type)
+        data = deepcopy(data)
+        with self.lock:
+            self.cache[key] = (stat, data)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
     
-    def set(self, filename: str, data: object, ruamel_type: str = "safe"):
-        self.cache[self._cache_key(filename, ruamel_type)] = data
+    def invalidate(self, filename: str):
+        """Removes a file from the cache for all ruamel types"""
+        path = os.path.abspath(filename)
+        with self.lock:
+            for key in [key for key in self.cache.keys() if key[0] == path]:
+                del self.cache[key]
 
 cache = YamlLoadCache()
 
 def pformat(d) -> str:
     return json.dumps(d, indent=4)
 
-def load_yaml(filename: str, version: float = 1.1, ruamel_type: str = "safe") -> dict:
-    """NOTE: use_pyyaml has been removed"""
+def load_yaml(filename: str, version: float = 1.1, ruamel_type: str = "safe", copy: bool = True) -> dict:
+    """NOTE: use_pyyaml has been removed. If copy is False, the returned data is shared and must not be mutated"""
     filename = str(filename)
-    cached = cache.get(filename, ruamel_type)
-    if cached:
+    cached = cache.get(filename, ruamel_type, copy=copy)
+    if cached is not None:
         return cached
+    stat = cache.stat(filename)
     with open(filename) as file:
         # Set YAML Version
         contents = f"%YAML {version}\n---\n" + file.read()
@@ -81,9 +130,23 @@ def load_yaml(filename: str, version: float = 1.1, ruamel_type: str = "safe") ->
         data = yaml.load(contents)
         if debug_mode:
             print(f"Opened YAML ({filename}): ", pformat(data))
-        cache.set(filename, data, ruamel_type)
+        cache.set(filename, data, ruamel_type, stat=stat)
+        if not copy:
+            # Hand out the cached copy so every caller shares it
+            return cache.get(filename, ruamel_type, copy=False) or data
         return data
 
+# Absolute so these work the same from the repo root and from inside data (during builds)
+DATA_DIR = pathlib.Path(__file__).resolve().parent.parent / "data"
+CORE_DIR = DATA_DIR / "core"
+
+def load_core(name: str) -> dict:
+    """
+    Loads data/core/{name}.yaml through the cache without copying it as core files are read 
+    on every request and many times per build. The data is shared and must not be mutated
+    """
+    return load_yaml(CORE_DIR / f"{name}.yaml", copy=False)
+
 def dump_yaml(filename: str, data, ruamel_type: str = "safe"):
     if isinstance(data, comments.CommentedMap):
         ruamel_type = "rt"
@@ -92,7 +155,7 @@ def dump_yaml(filename: str, data, ruamel_type: str = "safe"):
         yaml = YAML(typ=ruamel_type)
         yaml.dump(data, file)
     
-    threading.Thread(target=cache.clear).start()
+    cache.invalidate(str(filename))
 
 def input_int(prompt: str, *, tries: int = 0, return_none: bool = False) -> int:
     try:
@@ -107,12 +170,88 @@ def input_int(prompt: str, *, tries: int = 0, return_none: bool = False) -> int:
         print("Invalid input")
         return input_int(prompt, tries=tries+1)
 
-def write_min(d: dict, fp, no_debug: bool = False):
+# Lynx v2 stores dicts that share the same keys as positional arrays against a schema
+# and repeated strings as indexes into a string table. A v2 file is a msgpack array of 
+# [LYNX_V2_MAGIC, 2, {"schemas": [[key, ...], ...], "strings": [...]}, msgpack encoded body]
+LYNX_V2_MAGIC = "\x00lynx"
+LYNX_EXT_RECORD = 1 # msgpack array of [schema index, value, ...]
+LYNX_EXT_STRING = 2 # msgpack int that is the string table index
+
+def _lynx_v2_scan(d, schemas: Counter, strings: Counter):
+    if isinstance(d, dict):
+        if all(isinstance(k, str) for k in d.keys()):
+            schemas[tuple(d.keys())] += 1
+        for v in d.values():
+            _lynx_v2_scan(v, schemas, strings)
+    elif isinstance(d, (list, tuple)):
+        for v in d:
+            _lynx_v2_scan(v, schemas, strings)
+    elif isinstance(d, str):
+        strings[d] += 1
+
+def _lynx_v2_encode(d, schema_ids: Dict[tuple, int], string_ids: Dict[str, int]):
+    if isinstance(d, dict):
+        keys = tuple(d.keys())
+        if keys in schema_ids:
+            return msgpack.ExtType(
+                LYNX_EXT_RECORD, 
+                msgpack.packb([schema_ids[keys]] + [_lynx_v2_encode(v, schema_ids, string_ids) for v in d.values()])
+            )
+        return {k: _lynx_v2_encode(v, schema_ids, string_ids) for k, v in d.items()}
+    elif isinstance(d, (list, tuple)):
+        return [_lynx_v2_encode(v, schema_ids, string_ids) for v in d]
+    elif isinstance(d, str) and d in string_ids:
+        return msgpack.ExtType(LYNX_EXT_STRING, msgpack.packb(string_ids[d]))
+    return d
+
+def pack_lynx_v2(d) -> bytes:
+    schemas, strings = Counter(), Counter()
+    _lynx_v2_scan(d, schemas, strings)
+
+    # Only worth it if a schema or string is used more than once. Short strings are smaller inline
+    schema_list = [keys for keys, count in schemas.most_common() if count > 1]
+    string_list = [string for string, count in strings.most_common() if count > 1 and len(string.encode("utf-8")) > 3]
+    
+    schema_ids = {keys: i for i, keys in enumerate(schema_list)}
+    string_ids = {string: i for i, string in enumerate(string_list)}
+
+    body = msgpack.packb(_lynx_v2_encode(d, schema_ids, string_ids))
+    return msgpack.packb([
+        LYNX_V2_MAGIC, 
+        2, 
+        {"schemas": [list(keys) for keys in schema_list], "strings": [str(string) for string in string_list]}, 
+        body
+    ])
+
+def unpack_lynx_v2(header: dict, body: bytes):
+    schemas = header["schemas"]
+    strings = header["strings"]
+
+    def ext_hook(code: int, data: bytes):
+        if code == LYNX_EXT_RECORD:
+            values = msgpack.unpackb(data, ext_hook=ext_hook, strict_map_key=False)
+            return dict(zip(schemas[values[0]], values[1:]))
+        elif code == LYNX_EXT_STRING:
+            return strings[msgpack.unpackb(data)]
+        return msgpack.ExtType(code, data)
+
+    return msgpack.unpackb(body, ext_hook=ext_hook, strict_map_key=False)
+
+def write_min(d: dict, fp, no_debug: bool = False, version: int = 1):
+    """
+    Writes the lynx (and unless no_debug is set, the snowfall) file of some data
+
+    Version 2 is a lot smaller for data with many dicts of the same shape (such as resources) 
+    but needs a v2 aware reader (read_min and parseLynx in base.js)
+    """
     fn = pathlib.Path(fp.name)
 
     # Lynx is the file for use in production
     with fn.with_suffix(".lynx").open("wb") as fpb:
-        msgpack.pack(d, fpb)
+        if version == 2:
+            fpb.write(pack_lynx_v2(d))
+        else:
+            msgpack.pack(d, fpb)
 
     if not no_debug:
         # Snowfall is the debug file
@@ -120,10 +259,18 @@ def write_min(d: dict, fp, no_debug: bool = False):
             json.dump(d, fpb, indent=4)
 
 
+def hash_min(d) -> str:
+    """Returns the hash of the production (lynx) form of some data"""
+    return hashlib.sha256(msgpack.packb(d)).hexdigest()
+
 def read_min(filename: str):
     """Reads data accounting for any format changes"""
     with open(str(filename).replace(".min.json", ".lynx"), "rb") as fpb:
-        return msgpack.unpack(fpb, strict_map_key=False)
+        data = msgpack.unpack(fpb, strict_map_key=False)
+    
+    if isinstance(data, list) and len(data) == 4 and data[0] == LYNX_V2_MAGIC:
+        return unpack_lynx_v2(data[2], data[3])
+    return data
 
 def remove_ws(s: str) -> str:
     return s.replace("\n", "").replace("  ", "").replace("\t", " ")
@@ -7,8 +7,8 @@ import uuid
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 def create_new(grade: int, board: str, subject: str, name: str, iname: str):
-    boards = common.load_yaml("data/core/boards.yaml")
-    subjects = common.load_yaml("data/core/subjects.yaml")
+    boards = common.load_core("boards")
+    subjects = common.load_core("subjects")
 
     # Create the grade
     if grade > 12 or grade <= 0:
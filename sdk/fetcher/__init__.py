@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
 from sdk.fetcher.yt import Youtube
 from .classes import ScrapeData, ScrapeCache
 from sdk import common
@@ -7,19 +9,52 @@ scrapers = {
     "lnscrape": ln_scrape.ln_scrape
 }
 
-scrape_cache = ScrapeCache()
+# Titles picked so far by each scraper
+scrape_caches: Dict[str, ScrapeCache] = {}
 
 def get_channel_list():
-    return common.load_yaml("data/core/yt_channels.yaml")
+    return common.load_core("yt_channels")
 
-def scrape(yt: Youtube, chapter_info: dict, subtopic: str):
+def _scrape_channel(yt: Youtube, channel_info: dict, chapter_info: dict, subtopic: str, cache: ScrapeCache):
+    data = ScrapeData(yt=yt, channel_info=channel_info, chapter_info=chapter_info, subtopic=subtopic, scrape_cache=cache)
+    return scrapers[channel_info["scraper"]](data)
+
+def scrape_chapter(yt: Youtube, chapter_info: dict, subtopics: List[str], workers: int = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Scrapes every channel for every subtopic in parallel. Returns a map of subtopic to channel name to scraped data
+
+    Each scrape gets its own copy of its scrapers cache so they can run at the same time. Once all are done, 
+    they are merged back into the scraper caches in subtopic order. A scrape that picked a title an earlier one
+    also picked is redone against the merged cache, so the titles picked are the same as when scraping one at a time
+    """
     channel_list = get_channel_list()
-    scraped_data = {}
-    for name, channel_info in channel_list.items():
-        scrape_cache.set_current(channel_info["scraper"])
-        data = ScrapeData(yt=yt, channel_info=channel_info, chapter_info=chapter_info, subtopic=subtopic, scrape_cache=scrape_cache)
-        scraped_data[name] = scrapers[channel_info["scraper"]](data)
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=workers or min(32, len(subtopics) * len(channel_list) or 1)) as executor:
+        for subtopic in subtopics:
+            for name, channel_info in channel_list.items():
+                cache = scrape_caches.setdefault(channel_info["scraper"], ScrapeCache()).copy()
+                jobs[(subtopic, name)] = (
+                    channel_info,
+                    set(cache.titles),
+                    cache,
+                    executor.submit(_scrape_channel, yt, channel_info, chapter_info, subtopic, cache)
+                )
+
+    scraped_data = {subtopic: {} for subtopic in subtopics}
+    for (subtopic, name), (channel_info, base, cache, future) in jobs.items():
+        merged = scrape_caches[channel_info["scraper"]]
+        result = future.result()
+        if (cache.titles - base) & merged.titles:
+            print(f"Rescraping {name} for {subtopic} as it picked titles an earlier scrape already picked")
+            cache = merged.copy()
+            result = _scrape_channel(yt, channel_info, chapter_info, subtopic, cache)
+        scraped_data[subtopic][name] = result
+        merged.merge(cache)
     return scraped_data
 
+def scrape(yt: Youtube, chapter_info: dict, subtopic: str):
+    """Scrapes every channel for a subtopic in parallel"""
+    return scrape_chapter(yt, chapter_info, [subtopic])[subtopic]
+
 def scrape_cache_clear():
-    scrape_cache.clear()
\ No newline at end of file
+    scrape_caches.clear()
@@ -0,0 +1,176 @@
+"""
+Benchmarks chapter scrapes and title scoring offline against the YouTube replay server (see yt/replay.py)
+
+Run with python3 -m sdk.fetcher.bench --chapters "data/grades/*/*/*/*/info.yaml" --latency 0.05 --output bench.json
+Each run after the first reuses the cache of the runs before it so the first run is cold and the rest are warm.
+If --baseline is given, exits with 1 if a run got slower (past --tolerance) or made more requests than the baseline
+"""
+from pathlib import Path
+from typing import List, Optional
+from sdk import common
+from sdk.fetcher import scrape_chapter, scrape_cache_clear
+from sdk.fetcher.scrapers._parse import create_kwlist
+from sdk.fetcher.yt import Youtube
+from sdk.fetcher.yt.cache import YoutubeCache
+from sdk.fetcher.yt.classes import YoutubeData
+from sdk.fetcher.yt.quota import QuotaLedger, QuotaScheduler
+from sdk.fetcher.yt.replay import ReplayCredentials, ReplayServer, load_fixtures
+import argparse
+import asyncio
+import glob
+import json
+import sys
+import tempfile
+import time
+
+def load_chapter(path: Path) -> dict:
+    """Loads a grades/{grade}/{board}/{subject}/{chapter}/info.yaml the way gen_info does"""
+    grade, board, subject = path.parts[-5:-2]
+    chapter_info = common.load_yaml(path)
+    chapter_info["grade"] = int(grade)
+    chapter_info["board"] = board
+    chapter_info["subject"] = subject
+    for topic in chapter_info["topics"].values():
+        for key in ("accept", "reject"):
+            if topic.get(key) is None:
+                topic[key] = []
+    return chapter_info
+
+def _ratio(hits: int, total: int) -> float:
+    return hits / total if total else 0
+
+def bench_title_scoring(fixtures: dict, chapters: List[dict]) -> dict:
+    """Times get_title_with_kw for the keywords of every subtopic over every recorded playlist and playlist item title"""
+    responses = [YoutubeData(None, pages) for (t, _), pages in fixtures.items() if t in ("channelplaylists", "playlistitem")]
+    keyword_sets = [create_kwlist(chapter_info, topic) for chapter_info in chapters for topic in chapter_info["topics"]]
+    if not keyword_sets:
+        keyword_sets = [({"class": 4, "9": 3}, [])]
+
+    start = time.perf_counter()
+    for keywords, reject in keyword_sets:
+        for data in responses:
+            data.get_title_with_kw(keywords, reject, silent=True)
+    seconds = time.perf_counter() - start
+
+    return {
+        "keyword_sets": len(keyword_sets),
+        "titles": sum(1 for data in responses for _ in data.loop()),
+        "seconds": seconds
+    }
+
+def bench_scrapes(yt: Youtube, server: ReplayServer, cache: YoutubeCache, chapters: List[Path], run: int, workers: Optional[int]) -> dict:
+    results = []
+    run_start = time.perf_counter()
+    for path in chapters:
+        chapter_info = load_chapter(path)
+        scrape_cache_clear()
+        requests = sum(server.stats["requests"].values())
+        stats = dict(cache.stats)
+        error = None
+        start = time.perf_counter()
+        try:
+            scrape_chapter(yt, chapter_info, list(chapter_info["topics"].keys()), workers)
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+        seconds = time.perf_counter() - start
+
+        hits = cache.stats["hits"] - stats["hits"] + cache.stats["stale_hits"] - stats["stale_hits"]
+        misses = cache.stats["misses"] - stats["misses"]
+        results.append({
+            "chapter": str(path.parent),
+            "wall_seconds": seconds,
+            "requests": sum(server.stats["requests"].values()) - requests,
+            "cache_hits": hits,
+            "cache_misses": misses,
+            "hit_ratio": _ratio(hits, hits + misses),
+            "error": error
+        })
+        print(f"Run {run}: {path.parent} took {seconds:.2f}s, {results[-1]['requests']} requests, {results[-1]['hit_ratio']:.0%} cache hits{' (' + error + ')' if error else ''}")
+
+    hits = sum(r["cache_hits"] for r in results)
+    misses = sum(r["cache_misses"] for r in results)
+    return {
+        "run": run,
+        "wall_seconds": time.perf_counter() - run_start,
+        "requests": sum(r["requests"] for r in results),
+        "hit_ratio": _ratio(hits, hits + misses),
+        "errors": sum(1 for r in results if r["error"]),
+        "chapters": results
+    }
+
+async def bench(fixtures_path: str, chapter_glob: str, latency: float, jitter: float, runs: int, workers: Optional[int]) -> dict:
+    fixtures = load_fixtures(fixtures_path)
+    chapters = sorted(Path(p) for p in glob.glob(chapter_glob)) if chapter_glob else []
+    server = ReplayServer(fixtures, latency=latency, jitter=jitter)
+    url = await server.start()
+    print(f"Replaying {len(fixtures)} recorded responses on {url} for {len(chapters)} chapters")
+
+    report = {
+        "fixtures": len(fixtures),
+        "latency": latency,
+        "jitter": jitter,
+        "title_scoring": bench_title_scoring(fixtures, [load_chapter(path) for path in chapters]),
+        "runs": []
+    }
+
+    # Start from an empty cache and a ledger that never runs out
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = YoutubeCache(path=f"{tmp}/youtube.sqlite3")
+        scheduler = QuotaScheduler(daily_quota=10**12, reserve=0, rate=10**9, burst=10**9, ledger=QuotaLedger(f"{tmp}/quota.sqlite3"))
+        yt = Youtube(api_url=url, credentials=ReplayCredentials(), cache=cache, scheduler=scheduler)
+        try:
+            for run in range(1, runs + 1):
+                report["runs"].append(await asyncio.to_thread(bench_scrapes, yt, server, cache, chapters, run, workers))
+        finally:
+            await asyncio.to_thread(yt.close)
+            scheduler.ledger.close()
+            await server.stop()
+
+    report["missing_fixtures"] = sorted(set(server.stats["missing"]))
+    return report
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Returns the regressions of report against baseline"""
+    regressions = []
+    for run, old in zip(report["runs"], baseline["runs"]):
+        if run["wall_seconds"] > old["wall_seconds"] * (1 + tolerance):
+            regressions.append(f"Run {run['run']} took {run['wall_seconds']:.2f}s, was {old['wall_seconds']:.2f}s")
+        if run["requests"] > old["requests"]:
+            regressions.append(f"Run {run['run']} made {run['requests']} requests, was {old['requests']}")
+    old = baseline.get("title_scoring")
+    if old and report["title_scoring"]["seconds"] > old["seconds"] * (1 + tolerance):
+        regressions.append(f"Title scoring took {report['title_scoring']['seconds']:.2f}s, was {old['seconds']:.2f}s")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks chapter scrapes against recorded YouTube responses")
+    parser.add_argument("--fixtures", default="tmpstor", help="tmpstor directory or YoutubeCache database")
+    parser.add_argument("--chapters", default="data/grades/*/*/*/*/info.yaml", help="Glob of chapter info.yaml files to scrape")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds every replayed request is delayed by")
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=None, help="Scrape workers per chapter")
+    parser.add_argument("--output", help="Write the report as JSON here")
+    parser.add_argument("--baseline", help="Report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    report = asyncio.run(bench(args.fixtures, args.chapters, args.latency, args.jitter, args.runs, args.workers))
+
+    for run in report["runs"]:
+        print(f"Run {run['run']}: {run['wall_seconds']:.2f}s, {run['requests']} requests, {run['hit_ratio']:.0%} cache hits, {run['errors']} errors")
+    print(f"Title scoring: {report['title_scoring']['seconds']:.3f}s for {report['title_scoring']['titles']} titles x {report['title_scoring']['keyword_sets']} keyword sets")
+    if report["missing_fixtures"]:
+        print(f"WARNING: {len(report['missing_fixtures'])} requests had no recorded response")
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(report, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
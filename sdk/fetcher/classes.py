@@ -2,27 +2,27 @@ from typing import Optional
 from sdk.fetcher.yt import Youtube
 
 class ScrapeCache():
-    def __init__(self):
-        self.cache = {}
-        self.current = None
+    """Titles already picked by a scraper so they are not picked again"""
+    def __init__(self, titles: Optional[set] = None):
+        self.titles = set(titles or ())
     
-    def keys(self):
-        return self.cache.keys()
+    def get_cached(self) -> set:
+        return self.titles
     
-    def set_current(self, current: str):
-        if current not in self.keys():
-            self.cache[current] = []
-        self.current = current
-    
-    def get_cached(self) -> list:
-        return self.cache[self.current]
+    def is_cached(self, title: str) -> bool:
+        return title in self.titles
     
     def add(self, title: str):
-        self.cache[self.current].append(title)
+        self.titles.add(title)
+
+    def copy(self) -> "ScrapeCache":
+        return ScrapeCache(self.titles)
+
+    def merge(self, other: "ScrapeCache"):
+        self.titles |= other.titles
     
     def clear(self):
-        self.cache = {}
-        self.current = None
+        self.titles = set()
 
 # TODO
 class ScrapeOutput():
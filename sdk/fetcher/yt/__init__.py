@@ -1 +1,2 @@
-from .api import Youtube
\ No newline at end of file
+from .api import Youtube, AsyncYoutube
+from .quota import Priority, QuotaExceeded, get_scheduler
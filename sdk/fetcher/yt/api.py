@@ -1,144 +1,371 @@
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple, Type
 import google_auth_oauthlib.flow
-import googleapiclient.discovery
-import googleapiclient.errors
-from sdk import common
+import google.auth.transport.requests
 from pathlib import Path
-import time
-import orjson
+import asyncio
+import contextvars
+import threading
+import aiohttp
 import pickle
 import os
+from .cache import CacheEntry, YoutubeCache
+from .quota import Priority, QuotaScheduler, get_scheduler
 from .classes import YoutubeData, YoutubePlaylist, YoutubePlaylistItem, YoutubeVideo
 
 # For VSCode
 os.environ["IMPORT_YT_DONE"] = "1"
 
-class Youtube():
-    scopes = ["https://www.googleapis.com/auth/youtube.readonly"]
-    api_service_name = "youtube"
-    api_version = "v3"
-    client_secrets_file = "secrets/ytsecret.json"
-    secrets_cache_file = "secrets/creds_oauth.pickle"
-
-    # From google api explorer
-    def __init__(self):
-        # Get credentials and create an API client
-        credentials = self.get_credentials()
-        self.yt = googleapiclient.discovery.build(
-            self.api_service_name, self.api_version, credentials=credentials)
-        
-        # A cache for our use
-        self.etag_cache: Dict[str, dict] = {} # Caches our operation id to an etag
-        self.cache: Dict[str, dict] = {} # Cache an etag to a cache data
-
-    def get_credentials(self):
-        """Either get Credentials object using pickle or do oauth manually and store credentials"""
-        creds = Path(self.secrets_cache_file)
-        if creds.exists():
-            with creds.open('rb') as f:
-                return pickle.load(f)
+scopes = ["https://www.googleapis.com/auth/youtube.readonly"]
+client_secrets_file = "secrets/ytsecret.json"
+secrets_cache_file = "secrets/creds_oauth.pickle"
+
+VIDEOS_PER_REQUEST = 50 # Most ids videos.list accepts at once
+
+# Overrides the priority of a client for requests made in this context (such as background revalidation)
+request_priority: contextvars.ContextVar[Optional[Priority]] = contextvars.ContextVar("request_priority", default=None)
+
+def get_credentials():
+    """Either get Credentials object using pickle or do oauth manually and store credentials"""
+    creds = Path(secrets_cache_file)
+    if creds.exists():
+        with creds.open('rb') as f:
+            return pickle.load(f)
+    else:
+        flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
+            client_secrets_file, scopes)
+        credentials = flow.run_console()
+        with creds.open('wb') as f:
+            pickle.dump(credentials, f)
+        return credentials
+
+class AsyncYoutube():
+    """
+    Youtube Data API client that does not block the event loop
+
+    All requests share one aiohttp session so connections to the API are kept alive and reused.
+    Stale cached responses are returned right away while they are revalidated in the background 
+    using their etags. Every request goes through the shared QuotaScheduler at the priority of the client.
+    Concurrent requests for the same response (or video) share one API request.
+    Must only be used from the event loop it was first used in
+    """
+    api_url = "https://www.googleapis.com/youtube/v3"
+
+    def __init__(
+        self, 
+        owner: "Youtube" = None, 
+        max_connections: int = 10, 
+        cache: YoutubeCache = None, 
+        priority: Priority = Priority.interactive,
+        scheduler: QuotaScheduler = None,
+        api_url: str = None,
+        credentials = None
+    ):
+        self.cache = cache or YoutubeCache()
+        self.priority = priority
+        self.scheduler = scheduler or get_scheduler()
+        self.api_url = api_url or self.api_url # Such as a replay server (see replay.py)
+        self.credentials = credentials or get_credentials()
+        self.max_connections = max_connections
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._refresh_lock: Optional[asyncio.Lock] = None
+        self._revalidating: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._in_flight: Dict[tuple, asyncio.Task] = {} # Keyed by (cache type, cache id) and a page number for lazy pages
+        self._videos_in_flight: Dict[str, asyncio.Future] = {}
+
+        # The sync client if this client is owned by one. YoutubeData helpers like get_items need it
+        self.owner = owner
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if not self.session or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+                raise_for_status=True
+            )
+        return self.session
+
+    async def _get_token(self) -> str:
+        if not self._refresh_lock:
+            self._refresh_lock = asyncio.Lock()
+        if not self.credentials.valid:
+            async with self._refresh_lock:
+                if not self.credentials.valid:
+                    # google-auth only has a sync refresh
+                    await asyncio.to_thread(self.credentials.refresh, google.auth.transport.requests.Request())
+        return self.credentials.token
+
+    async def close(self):
+        for task in list(self._revalidating.values()):
+            task.cancel()
+        await asyncio.gather(*self._revalidating.values(), return_exceptions=True)
+        if self.session:
+            await self.session.close()
+        self.cache.close()
+
+    async def _get(self, endpoint: str, params: dict, etag: str = None) -> Optional[dict]:
+        """Makes a request. If etag is given and youtube says the response has not changed, returns None"""
+        priority = request_priority.get()
+        await self.scheduler.acquire(endpoint, self.priority if priority is None else priority)
+        session = await self._get_session()
+        headers = {"Authorization": f"Bearer {await self._get_token()}"}
+        if etag:
+            headers["If-None-Match"] = etag
+        async with session.get(f"{self.api_url}/{endpoint}", params=params, headers=headers) as res:
+            if res.status == 304:
+                return None
+            return await res.json()
+
+    async def _paginate(self, endpoint: str, params: dict, cached: List[dict] = None, max_pages: int = None) -> Tuple[List[dict], bool]:
+        """
+        Fetches every page (or the first max_pages pages) of a response. Returns the pages and whether anything changed
+
+        If cached pages are given, each page is revalidated against its etag and reused if unchanged
+        """
+        cached = cached or []
+        data = []
+        changed = False
+        while True:
+            page_params = params | {"pageToken": data[-1]["nextPageToken"]} if data else params
+            old = cached[len(data)] if len(data) < len(cached) else None
+            page = await self._get(endpoint, page_params, etag=old.get("etag") if old else None)
+            if page is None:
+                page = old
+            else:
+                changed = True
+            data.append(page)
+            if not page.get("nextPageToken") or (max_pages and len(data) >= max_pages):
+                break
+        return data, changed or len(data) != len(cached)
+
+    async def _revalidate(
+        self, 
+        endpoint: str, 
+        params: dict, 
+        cache_type: str, 
+        cache_id: str, 
+        entry: Optional[CacheEntry], 
+        max_pages: int = None
+    ) -> List[dict]:
+        data, changed = await self._paginate(endpoint, params, entry.pages if entry else None, max_pages)
+        if changed:
+            self.cache.set(cache_type, cache_id, data)
         else:
-            flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
-                self.client_secrets_file, self.scopes)
-            credentials = flow.run_console()
-            with creds.open('wb') as f:
-                pickle.dump(credentials, f)
-            return credentials
-
-    def _fcache_req(self, t: str, id: str) -> Optional[List[dict]]:
-        """Attempt to fetch request from cache"""
-        Path(f"tmpstor").mkdir(exist_ok=True)
-        f = f"tmpstor/cache-{t}-{id}"
-        fpath = Path(f"{f}.lynx")        
-        if self.etag_cache.get(f):
-            cache_data = self.cache[self.etag_cache[f]]
-        
-        elif fpath.exists():
-            cache_data = common.read_min(fpath)
-        
+            self.cache.touch(cache_type, cache_id)
+            data = entry.data
+        return data
+
+    async def _single_flight(self, key: tuple, coro):
+        """Runs coro, unless one for key is already running in which case coro is dropped and that result is shared"""
+        task = self._in_flight.get(key)
+        if task:
+            coro.close()
         else:
-            return None
-
-        if time.time() - float(cache_data[-1]["time"]) > 60*60*24:
-            return None
-        
-        self._cache_etag(f, cache_data[0]["etag"], cache_data)
-
-        return cache_data
-    
-    def _wcache_req(self, t: str, id: str, data: List[dict]):
-        data.append({"time": str(time.time()), "internal": True})
-        Path(f"tmpstor").mkdir(exist_ok=True)
-        f = f"tmpstor/cache-{t}-{id}"
-        fpath = Path(f"{f}.lynx")  
-        with fpath.open("w") as fp:
-            common.write_min(data, fp, no_debug=True)
-        self._cache_etag(f, data[0]["etag"], data)
-
-    def _cache_etag(self, id: str, etag: str, data: dict):
-        self.cache[etag] = data
-        self.etag_cache[id] = etag
-    
-    def _paginate(self, request: Callable, curr_data: dict, data: List[dict] = None):
-        if not data:
-            data = [curr_data]
-        if curr_data.get("nextPageToken"):
-            page_token = curr_data["nextPageToken"]
-            next_req = googleapiclient.http.HttpRequest(
-                request.http, request.postproc, f"{request.uri}&pageToken={page_token}", body=request.body, headers=request.headers, methodId=request.methodId
+            task = asyncio.ensure_future(coro)
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # One caller being cancelled must not cancel the request for the rest
+        return await asyncio.shield(task)
+
+    def _revalidate_later(self, key: Tuple[str, str], coro):
+        """Runs a revalidation in the background unless one is already running for key"""
+        if key in self._revalidating:
+            coro.close()
+            return
+
+        async def run():
+            request_priority.set(Priority.bulk)
+            try:
+                await coro
+            except Exception as exc:
+                print(f"WARNING: Could not revalidate {key}: {exc}")
+            finally:
+                del self._revalidating[key]
+
+        self._revalidating[key] = asyncio.create_task(run())
+
+    def _pager(self, endpoint: str, params: dict, cache_type: str, cache_id: str) -> Callable[[List[dict]], dict]:
+        """
+        Returns a function that fetches the page after the given pages (for YoutubeData.loop) and caches all the pages 
+        so far. Pages are fetched through the sync client so this is only usable if this client is owned by one
+        """
+        def fetch_page(pages: List[dict]) -> dict:
+            return self.owner._run(self._single_flight(
+                (cache_type, cache_id, len(pages)), 
+                self._fetch_page(endpoint, params, cache_type, cache_id, pages)
+            ))
+        return fetch_page
+
+    async def _fetch_page(self, endpoint: str, params: dict, cache_type: str, cache_id: str, pages: List[dict]) -> dict:
+        # Another YoutubeData over the same response may have already fetched (and cached) this page
+        entry = self.cache.get(cache_type, cache_id)
+        if entry and len(entry.pages) > len(pages) and entry.pages[len(pages) - 1].get("nextPageToken") == pages[-1]["nextPageToken"]:
+            return entry.pages[len(pages)]
+        page = await self._get(endpoint, params | {"pageToken": pages[-1]["nextPageToken"]})
+        self.cache.set(cache_type, cache_id, [*pages, page])
+        return page
+
+    async def request(self, endpoint: str, params: dict, cache_type: str, cache_id: str, cls: Type[YoutubeData] = YoutubeData) -> YoutubeData:
+        """
+        Fetches a (cached) response. If this client is owned by a sync client, only the first page is fetched 
+        and the rest are fetched as the YoutubeData is looped over. Otherwise, all pages are fetched
+        """
+        # Only as many pages as have been looped over may be cached
+        lazy = self.owner is not None
+        entry = self.cache.get(cache_type, cache_id)
+        if not entry:
+            data = await self._single_flight(
+                (cache_type, cache_id), 
+                self._revalidate(endpoint, params, cache_type, cache_id, None, 1 if lazy else None)
             )
-            next_data = next_req.execute()
-            data.append(next_data)
-            return self._paginate(next_req, next_data, data)
+        elif not lazy and entry.pages[-1].get("nextPageToken"):
+            data = await self._single_flight((cache_type, cache_id), self._revalidate(endpoint, params, cache_type, cache_id, entry))
         else:
-            return data
+            if not entry.fresh:
+                pages = entry.pages
+                self._revalidate_later(
+                    (cache_type, cache_id), 
+                    self._revalidate(endpoint, params, cache_type, cache_id, entry, len(pages) if lazy else None)
+                )
+            else:
+                print("Using already cached response")
+            data = entry.data
+        return cls(self.owner or self, data, self._pager(endpoint, params, cache_type, cache_id) if lazy else None)
 
-    def request(self, request: Callable, cache_type: str, cache_id: str, cls: YoutubeData = YoutubeData) -> List[Dict]:
-        data = self._fcache_req(cache_type, cache_id)
-        if not data:
-            api_data = self._paginate(request, request.execute())
-            self._wcache_req(cache_type, cache_id, api_data)
-            return cls(self, api_data)
+    async def get_channel(self, channel_id: str) -> YoutubeData:
+        """https://developers.google.com/youtube/v3/docs/channels#resource"""
+        return await self.request("channels", {
+            "part": "snippet,contentDetails,statistics,localizations,contentOwnerDetails,statistics",
+            "maxResults": 50,
+            "id": channel_id
+        }, "channel", channel_id)
 
-        print("Using already cached response")
-        return cls(self, data)
+    async def get_all_playlists(self, channel_id: str) -> YoutubePlaylist:
+        """https://developers.google.com/youtube/v3/docs/playlists#resource"""
+        return await self.request("playlists", {
+            "part": "snippet,contentDetails,localizations,id,player",
+            "maxResults": 50,
+            "channelId": channel_id
+        }, "channelplaylists", channel_id, YoutubePlaylist)
 
-    def get_channel(self, channel_id: str) -> YoutubeData:
-        """https://developers.google.com/youtube/v3/docs/channels#resource"""
-        request = self.yt.channels().list(
-            part="snippet,contentDetails,statistics,localizations,contentOwnerDetails,statistics",
-            maxResults=50,
-            id=channel_id
-        )
+    async def get_playlist_item(self, playlist_id: str) -> YoutubePlaylistItem:
+        """https://developers.google.com/youtube/v3/docs/playlistItems#resource"""
+        return await self.request("playlistItems", {
+            "part": "snippet,contentDetails",
+            "maxResults": 50,
+            "playlistId": playlist_id
+        }, "playlistitem", playlist_id, YoutubePlaylistItem)
+
+    async def get_video(self, video_id: str) -> YoutubeVideo:
+        """https://developers.google.com/youtube/v3/docs/videos#resource"""
+        return await self.request("videos", {
+            "part": "snippet,contentDetails,statistics,player",
+            "maxResults": 50,
+            "id": video_id
+        }, "video", video_id, YoutubeVideo)
+
+    async def get_videos(self, video_ids: List[str]) -> Dict[str, YoutubeVideo]:
+        """
+        Gets many videos using as few requests as possible. Returns a map of video id to video
+
+        Cached videos are served from cache and the rest are fetched in batches of 50 (the most videos.list allows) 
+        which are then cached per video, so get_video and get_videos share the same cache. Stale videos are 
+        refetched in the background (etags can't be used for a batch)
+        """
+        video_ids = list(dict.fromkeys(video_ids)) # Dedupe while keeping order
+        cached = self.cache.get_many("video", video_ids)
+        videos = {video_id: YoutubeVideo(self.owner or self, entry.data) for video_id, entry in cached.items()}
+
+        stale = [video_id for video_id, entry in cached.items() if not entry.fresh]
+        if stale:
+            self._revalidate_later(("video", ",".join(stale)), self._fetch_videos(stale))
+
+        pending = [video_id for video_id in video_ids if video_id not in videos]
+        for video_id, data in (await self._fetch_videos(pending)).items():
+            videos[video_id] = YoutubeVideo(self.owner or self, data)
+
+        return videos
+
+    async def _fetch_videos(self, video_ids: List[str]) -> Dict[str, List[dict]]:
+        """Fetches and caches videos in batches of VIDEOS_PER_REQUEST. Videos that are already being fetched are waited on instead"""
+        waiting = {video_id: self._videos_in_flight[video_id] for video_id in video_ids if video_id in self._videos_in_flight}
+        pending = [video_id for video_id in video_ids if video_id not in waiting]
+        loop = asyncio.get_running_loop()
+        flights = {video_id: loop.create_future() for video_id in pending}
+        self._videos_in_flight |= flights
+
+        videos = {}
+        try:
+            for i in range(0, len(pending), VIDEOS_PER_REQUEST):
+                chunk = pending[i:i+VIDEOS_PER_REQUEST]
+                res = await self._get("videos", {
+                    "part": "snippet,contentDetails,statistics,player",
+                    "maxResults": VIDEOS_PER_REQUEST,
+                    "id": ",".join(chunk)
+                })
+                items = {item["id"]: item for item in res.get("items", [])}
+                responses = {}
+                for video_id in chunk:
+                    item = items.get(video_id)
+                    responses[video_id] = [{
+                        "kind": res.get("kind"),
+                        "etag": item["etag"] if item else f"{res.get('etag')}-{video_id}",
+                        "items": [item] if item else [],
+                        "pageInfo": {"totalResults": 1 if item else 0, "resultsPerPage": 1}
+                    }]
+                self.cache.set_many("video", responses)
+                for video_id, data in responses.items():
+                    flights[video_id].set_result(data)
+                videos |= responses
+        except BaseException as exc:
+            for flight in flights.values():
+                if flight.done():
+                    continue
+                if isinstance(exc, asyncio.CancelledError):
+                    flight.cancel()
+                else:
+                    flight.set_exception(exc)
+                    flight.exception() # Whoever waits gets it, don't warn if nobody does
+            raise
+        finally:
+            for video_id, flight in flights.items():
+                if self._videos_in_flight.get(video_id) is flight:
+                    del self._videos_in_flight[video_id]
 
-        return self.request(request, "channel", channel_id)
+        for video_id, flight in waiting.items():
+            videos[video_id] = await asyncio.shield(flight)
+        return videos
+
+class Youtube():
+    """
+    Sync wrapper around AsyncYoutube for sync callers such as the scrapers
+
+    Requests are run on a private event loop in a background thread so this is safe to call from anywhere,
+    including code that is itself running in an event loop (it will block that loop though)
+    """
+    def __init__(self, **kwargs):
+        """kwargs are passed on to AsyncYoutube"""
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="youtube", daemon=True)
+        self.thread.start()
+        self.aio = AsyncYoutube(owner=self, priority=Priority.bulk, **kwargs)
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        self._run(self.aio.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def get_channel(self, channel_id: str) -> YoutubeData:
+        return self._run(self.aio.get_channel(channel_id))
 
     def get_all_playlists(self, channel_id: str) -> YoutubePlaylist:
-        """https://developers.google.com/youtube/v3/docs/playlists#resource"""
-        request = self.yt.playlists().list(
-            part="snippet,contentDetails,localizations,id,player",
-            maxResults=50,
-            channelId=channel_id
-        )
-
-        return self.request(request, "channelplaylists", channel_id, YoutubePlaylist)
-    
+        return self._run(self.aio.get_all_playlists(channel_id))
+
     def get_playlist_item(self, playlist_id: str) -> YoutubePlaylistItem:
-        """https://developers.google.com/youtube/v3/docs/playlistItems#resource"""
-        request = self.yt.playlistItems().list(
-            part="snippet,contentDetails",
-            maxResults=50,
-            playlistId=playlist_id
-        )
-
-        return self.request(request, "playlistitem", playlist_id, YoutubePlaylistItem)
-    
+        return self._run(self.aio.get_playlist_item(playlist_id))
+
     def get_video(self, video_id: str) -> YoutubeVideo:
-        """https://developers.google.com/youtube/v3/docs/videos#resource"""
-        request = self.yt.videos().list(
-            part="snippet,contentDetails,statistics,player",
-            maxResults=50,
-            id=video_id
-        )
+        return self._run(self.aio.get_video(video_id))
 
-        return self.request(request, "video", video_id, YoutubeVideo)
+    def get_videos(self, video_ids: List[str]) -> Dict[str, YoutubeVideo]:
+        return self._run(self.aio.get_videos(video_ids))
@@ -0,0 +1,205 @@
+"""SQLite backed cache of youtube responses"""
+from typing import Dict, List, NamedTuple, Optional
+from pathlib import Path
+from sdk import common
+import sqlite3
+import threading
+import msgpack
+import time
+
+# How long (in seconds) each type of response is fresh for. Channels and videos rarely change in ways we care about
+TTLS = {
+    "channel": 60*60*24*7,
+    "channelplaylists": 60*60*24,
+    "playlistitem": 60*60*24,
+    "video": 60*60*24*3,
+}
+DEFAULT_TTL = 60*60*24
+
+class CacheEntry(NamedTuple):
+    data: List[dict]
+    etag: Optional[str]
+    fresh: bool # False once the ttl has passed. Stale entries should be served while being refreshed
+
+    @property
+    def pages(self) -> List[dict]:
+        """The response pages without the internal time element"""
+        return [page for page in self.data if not page.get("internal")]
+
+class YoutubeCache():
+    """
+    Caches youtube responses in a single SQLite database keyed by (type, id)
+
+    Each type of response has its own ttl (see TTLS). Stale responses are kept for max_stale seconds 
+    after their ttl so they can be served while they are revalidated. Once the database holds more than max_bytes
+    of responses, the least recently used ones are evicted. Old tmpstor/cache-*.lynx files are imported
+    (but left in place) the first time the cache sees them
+    """
+    def __init__(
+        self, 
+        path: str = "tmpstor/youtube.sqlite3", 
+        ttls: Dict[str, int] = None, 
+        max_stale: int = 60*60*24*30, 
+        max_bytes: int = 512*1024*1024
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True)
+        self.ttls = TTLS | (ttls or {})
+        self.max_stale = max_stale
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS responses (
+                type TEXT NOT NULL,
+                id TEXT NOT NULL,
+                etag TEXT,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                stale_at REAL NOT NULL,
+                PRIMARY KEY (type, id)
+            );
+            CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+            CREATE TABLE IF NOT EXISTS migrated_files (
+                name TEXT PRIMARY KEY,
+                mtime INTEGER NOT NULL
+            );
+        """)
+        self._upgrade()
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_stale_at ON responses (stale_at)")
+        self.migrate(self.path.parent)
+
+    def _upgrade(self):
+        """Adds stale_at to databases made before ttls were per type"""
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(responses)")]
+        if "stale_at" in columns:
+            return
+        with self.db:
+            self.db.execute("DROP INDEX IF EXISTS responses_fetched_at")
+            self.db.execute("ALTER TABLE responses ADD COLUMN stale_at REAL NOT NULL DEFAULT 0")
+            for t in [row[0] for row in self.db.execute("SELECT DISTINCT type FROM responses")]:
+                self.db.execute("UPDATE responses SET stale_at = fetched_at + ? WHERE type = ?", (self.get_ttl(t), t))
+
+    def get_ttl(self, t: str) -> int:
+        return self.ttls.get(t, DEFAULT_TTL)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, t: str, id: str) -> Optional[CacheEntry]:
+        """Attempt to fetch a response (fresh or stale) from cache"""
+        return self.get_many(t, [id]).get(id)
+
+    def get_many(self, t: str, ids: List[str]) -> Dict[str, CacheEntry]:
+        """Fetches all responses of a type from cache, fresh or stale. Missing ids are left out"""
+        if not ids:
+            return {}
+        now = time.time()
+        found = {}
+        with self.lock, self.db:
+            # SQLite has a limit on the number of host parameters
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                rows = self.db.execute(
+                    f"SELECT id, data, etag, stale_at FROM responses WHERE type = ? AND stale_at > ? AND id IN ({','.join('?' * len(chunk))})",
+                    [t, now - self.max_stale, *chunk]
+                ).fetchall()
+                for id, data, etag, stale_at in rows:
+                    found[id] = CacheEntry(msgpack.unpackb(data, strict_map_key=False), etag, stale_at > now)
+            stale = sum(not entry.fresh for entry in found.values())
+            self.stats["hits"] += len(found) - stale
+            self.stats["stale_hits"] += stale
+            self.stats["misses"] += len(ids) - len(found)
+            if found:
+                self.db.executemany(
+                    "UPDATE responses SET used_at = ? WHERE type = ? AND id = ?",
+                    [(now, t, id) for id in found.keys()]
+                )
+        return found
+
+    def set(self, t: str, id: str, data: List[dict]):
+        self.set_many(t, {id: data})
+
+    def set_many(self, t: str, responses: Dict[str, List[dict]]):
+        """Caches many responses of a type in one transaction. Adds the internal time element to each response"""
+        now = time.time()
+        rows = []
+        for id, data in responses.items():
+            data.append({"time": str(now), "internal": True})
+            packed = msgpack.packb(data)
+            rows.append((t, id, data[0].get("etag"), packed, len(packed), now, now, now + self.get_ttl(t)))
+
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._evict()
+
+    def touch(self, t: str, id: str):
+        """Marks a response as fresh again without rewriting it (such as when youtube says it has not changed)"""
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE responses SET fetched_at = ?, stale_at = ? WHERE type = ? AND id = ?", 
+                (now, now + self.get_ttl(t), t, id)
+            )
+
+    def _evict(self):
+        """Removes responses stale for over max_stale and then the least recently used ones until the cache fits in max_bytes"""
+        self.db.execute("DELETE FROM responses WHERE stale_at <= ?", (time.time() - self.max_stale,))
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        self.db.execute("""
+            DELETE FROM responses WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, SUM(size) OVER (ORDER BY used_at DESC, rowid DESC) AS running FROM responses
+                ) WHERE running > ?
+            )
+        """, (self.max_bytes,))
+
+    def migrate(self, tmpstor: Path):
+        """
+        Imports the old per request tmpstor/cache-{type}-{id}.lynx files (some of which are tracked in git)
+
+        The files are left alone and are only imported again if they change. Responses past their ttl are 
+        imported as stale from now on so they are served while being revalidated instead of being evicted
+        """
+        files = list(tmpstor.glob("cache-*.lynx"))
+        if not files:
+            return
+
+        with self.lock:
+            done = dict(self.db.execute("SELECT name, mtime FROM migrated_files").fetchall())
+
+        now = time.time()
+        rows = []
+        migrated = []
+        for f in files:
+            mtime = f.stat().st_mtime_ns
+            if done.get(f.name) == mtime:
+                continue
+            try:
+                _, t, id = f.stem.split("-", 2)
+                data = common.read_min(f)
+                fetched_at = float(data[-1]["time"])
+            except Exception as exc:
+                print(f"WARNING: Could not migrate {f}: {exc}")
+                continue
+            packed = msgpack.packb(data)
+            rows.append((t, id, data[0].get("etag"), packed, len(packed), fetched_at, now, max(fetched_at + self.get_ttl(t), now)))
+            migrated.append((f.name, mtime))
+
+        if not migrated:
+            return
+
+        with self.lock, self.db:
+            # Keep anything newer that is already in the database. Nothing is evicted here as that would
+            # drop the imported responses, the next write evicts as usual
+            self.db.executemany("INSERT OR IGNORE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT OR REPLACE INTO migrated_files VALUES (?, ?)", migrated)
+        print(f"Migrated {len(rows)} cached youtube responses to {self.path}")
@@ -1,5 +1,7 @@
-from copy import deepcopy
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
+from .matcher import get_matcher
+import asyncio
+import heapq
 import os
 
 # For VSCode
@@ -7,18 +9,37 @@ if True is False:
     from sdk.fetcher import ScrapeCache
     from sdk.fetcher.yt import Youtube
 
+def _check_sync(yt, async_variant: str):
+    if asyncio.iscoroutinefunction(getattr(yt, "get_videos", None)):
+        raise TypeError(f"This was gotten from an AsyncYoutube, use {async_variant} instead")
+
 class YoutubeData():
-    def __init__(self, yt: "Youtube", data):
-        self.data = deepcopy(data)
-        self.internal_data = self.data[-1]
-        del self.data[-1]
+    """
+    A view over the pages of a youtube response. Pages are not copied so they must not be mutated
+    
+    If fetch_page is given, pages after the ones in data are fetched as loop() reaches them
+    """
+    def __init__(self, yt: "Youtube", data: List[dict], fetch_page: Optional[Callable[[List[dict]], dict]] = None):
+        if data and data[-1].get("internal"):
+            self.internal_data = data[-1]
+            data = data[:-1]
+        else:
+            self.internal_data = {}
+        self.data = data
+        self.fetch_page = fetch_page
         self.yt = yt
         self.exit_loop = None
     
     def loop(self):
-        for page in self.data:
-            for item in page["items"]:
+        i = 0
+        while True:
+            if i == len(self.data):
+                if not self.data or not self.data[-1].get("nextPageToken") or not self.fetch_page:
+                    return
+                self.data.append(self.fetch_page(self.data))
+            for item in self.data[i]["items"]:
                 yield item
+            i += 1
     
     def get_item_title(self, item):
         """Should work in many cases. Gets the title of an item"""
@@ -26,7 +47,7 @@ class YoutubeData():
     
     def item_min(self, item) -> dict:
         """Minifies a item"""
-        return item
+        return dict(item)
 
     def get_title_with_kw(
         self, 
@@ -36,48 +57,35 @@ class YoutubeData():
         silent: bool = False, 
         cache: "ScrapeCache" = None
     ):
-        """Helper method to get all titles matching a set of keywords where keywords is a map of the keyword to its weightage"""
+        """
+        Helper method to get all titles matching a set of keywords where keywords is a map of the keyword to its weightage
+
+        The keywords are compiled once (see matcher.get_matcher) and only the top max_results titles are kept
+        """
+        matcher = get_matcher(keywords, reject_keywords)
         keyword_map = {} # Store how many keyword maps
         for item in self.loop():
             title = self.get_item_title(item)
 
             if cache:
-                if title in cache.get_cached():
+                if cache.is_cached(title):
                     if not silent:
-                        print("Ignoring cached title: ", cache.get_cached())
+                        print("Ignoring cached title: ", title)
                     continue
 
-            item_min = self.item_min(item)
-            item_min["weight"] = 0
-
-            keyword_map[title] = item_min
-            
-            title_list = [s.lower() for s in title.split(" ")]
-            for kw, weight in keywords.items():
-                if kw.lower() in title_list:
-                    keyword_map[title]["weight"] += weight
-                elif kw.lower() in title.lower():
-                    # Anywhere in title means 0.5 weightage
-                    keyword_map[title]["weight"] += 0.5*weight
-                
-            if reject_keywords:
-                for kw in reject_keywords:
-                    if kw in title.lower():
-                        keyword_map[title]["weight"] = 0
-                        break
-
-            if keyword_map[title]["weight"] == 0:
-                del keyword_map[title]
+            weight = matcher.score(title)
+            if weight:
+                item_min = self.item_min(item)
+                item_min["weight"] = weight
+                keyword_map[title] = item_min
+            else:
+                keyword_map.pop(title, None)
 
             if not silent:
                 print(title)
         
-        if keyword_map:
-            keyword_map = sorted(keyword_map.items(), key=lambda x: x[1]["weight"], reverse=True)
-        else:
-            keyword_map = []
-        
-        keyword_map = keyword_map[:max_results]
+        # Same order as a stable sort by weight
+        keyword_map = heapq.nlargest(max_results, keyword_map.items(), key=lambda x: x[1]["weight"])
         
         titles = [title[0] for title in keyword_map]
         if cache:
@@ -97,20 +105,47 @@ class YoutubePlaylist(YoutubeData):
 
     def get_items(self, title_list: List[str] = None):
         """Get all playlist items in a generator"""
+        _check_sync(self.yt, "aget_items")
         for item in self.loop():
             if title_list and self.get_item_title(item) not in title_list:
                 continue
             if self.exit_loop != "get_items":
                 yield self.yt.get_playlist_item(item["id"])
 
-
-class YoutubePlaylistItem(YoutubeData):
-    def get_videos(self, title_list: List[str] = None):
+    async def aget_items(self, title_list: List[str] = None):
+        """get_items for playlists gotten from an AsyncYoutube"""
         for item in self.loop():
             if title_list and self.get_item_title(item) not in title_list:
                 continue
+            if self.exit_loop != "get_items":
+                yield await self.yt.get_playlist_item(item["id"])
+
+
+class YoutubePlaylistItem(YoutubeData):
+    def _video_ids(self, title_list: Optional[List[str]]) -> List[str]:
+        return [
+            item["contentDetails"]["videoId"] for item in self.loop() 
+            if not title_list or self.get_item_title(item) in title_list
+        ]
+
+    def get_videos(self, title_list: List[str] = None):
+        """Get all videos in a generator. Videos are fetched in batches (see Youtube.get_videos)"""
+        _check_sync(self.yt, "aget_videos")
+        video_ids = self._video_ids(title_list)
+        if not video_ids:
+            return
+        videos = self.yt.get_videos(video_ids)
+        for video_id in video_ids:
             if self.exit_loop != "get_vids":
-                yield self.yt.get_video(item["contentDetails"]["videoId"])
+                yield videos[video_id]
+
+    async def aget_videos(self, title_list: List[str] = None) -> List["YoutubeVideo"]:
+        """get_videos for playlist items gotten from an AsyncYoutube"""
+        video_ids = self._video_ids(title_list)
+        if not video_ids:
+            return []
+        videos = await self.yt.get_videos(video_ids)
+        return [videos[video_id] for video_id in video_ids]
 
 class YoutubeVideo(YoutubeData):
     def item_min(self, item) -> dict:
@@ -0,0 +1,98 @@
+"""Keyword matching for scoring titles (see YoutubeData.get_title_with_kw)"""
+from collections import deque
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
+
+# Below this many patterns, a `in` check per pattern (done in C) beats walking the automaton in Python
+AUTOMATON_MIN_PATTERNS = 96
+
+class SubstringAutomaton():
+    """
+    Aho-Corasick automaton that finds which of many patterns occur in a string in one pass
+
+    Small pattern sets are just scanned for instead (see AUTOMATON_MIN_PATTERNS)
+    """
+    def __init__(self, patterns: List[str]):
+        # The empty string occurs in everything
+        self.always = {""} if "" in patterns else set()
+        self.patterns = [pattern for pattern in dict.fromkeys(patterns) if pattern]
+        self.scan = len(self.patterns) < AUTOMATON_MIN_PATTERNS
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[Set[str]] = [set()]
+
+        if self.scan:
+            return
+
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].add(pattern)
+
+        # Breadth first so the fail state of a node is always done before the node
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+
+    def find(self, text: str) -> Set[str]:
+        """Returns every pattern that occurs in text"""
+        if self.scan:
+            return self.always | {pattern for pattern in self.patterns if pattern in text}
+
+        found = set(self.always)
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+class KeywordMatcher():
+    """
+    Scores titles against a set of weighted keywords and reject keywords
+
+    A keyword that is a whole word of the title counts for its full weight and one found anywhere
+    else in the title counts for half. A title containing a reject keyword scores 0
+    """
+    def __init__(self, keywords: Dict[str, int], reject_keywords: Optional[List[str]] = None):
+        # Keywords that only differ in case both count
+        self.weights: Dict[str, float] = {}
+        for kw, weight in keywords.items():
+            self.weights[kw.lower()] = self.weights.get(kw.lower(), 0) + weight
+        self.accept = SubstringAutomaton(list(self.weights.keys()))
+        # Reject keywords are matched as given against the lowercased title
+        self.reject = SubstringAutomaton(list(reject_keywords or []))
+        self.has_reject = bool(reject_keywords)
+
+    def score(self, title: str) -> float:
+        lower = title.lower()
+        if self.has_reject and self.reject.find(lower):
+            return 0
+        found = self.accept.find(lower)
+        if not found:
+            return 0
+        words = set(lower.split(" "))
+        return sum(self.weights[kw] if kw in words else 0.5*self.weights[kw] for kw in found)
+
+@lru_cache(maxsize=256)
+def _get_matcher(keywords: Tuple[Tuple[str, int], ...], reject_keywords: Tuple[str, ...]) -> KeywordMatcher:
+    return KeywordMatcher(dict(keywords), list(reject_keywords))
+
+def get_matcher(keywords: Dict[str, int], reject_keywords: Optional[List[str]] = None) -> KeywordMatcher:
+    """Returns a compiled matcher for a keyword set. Matchers are reused for the same keyword set"""
+    return _get_matcher(tuple(keywords.items()), tuple(reject_keywords or ()))
@@ -0,0 +1,177 @@
+"""YouTube Data API quota accounting and request scheduling"""
+from aenum import IntEnum
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+import asyncio
+import sqlite3
+import threading
+import time
+import os
+
+# Units each endpoint costs per request (https://developers.google.com/youtube/v3/determine_quota_cost)
+UNIT_COSTS = {
+    "channels": 1,
+    "playlists": 1,
+    "playlistItems": 1,
+    "videos": 1,
+    "search": 100,
+}
+DEFAULT_COST = 1
+
+# The quota resets at midnight pacific time
+QUOTA_TZ = ZoneInfo("America/Los_Angeles")
+
+class Priority(IntEnum):
+    _init_ = 'value __doc__'
+    interactive = 0, "Admin requests such as new_resource, may use the whole quota"
+    bulk = 1, "Scrapers and background revalidation, deferred once only the reserve is left"
+
+class QuotaExceeded(Exception):
+    pass
+
+def quota_day() -> str:
+    return datetime.now(QUOTA_TZ).strftime("%Y-%m-%d")
+
+def seconds_to_reset() -> float:
+    now = datetime.now(QUOTA_TZ)
+    reset = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (reset - now).total_seconds()
+
+class QuotaLedger():
+    """Units used per (pacific) day, stored in SQLite so every process shares it"""
+    def __init__(self, path: str = "tmpstor/youtube.sqlite3"):
+        Path(path).parent.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS quota_ledger (
+                day TEXT PRIMARY KEY,
+                units INTEGER NOT NULL DEFAULT 0,
+                requests INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def used(self, day: str = None) -> int:
+        with self.lock:
+            row = self.db.execute("SELECT units FROM quota_ledger WHERE day = ?", (day or quota_day(),)).fetchone()
+        return row[0] if row else 0
+
+    def charge(self, units: int, limit: int) -> bool:
+        """Atomically charges units to today if that keeps today at or under limit. Returns whether it was charged"""
+        day = quota_day()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO quota_ledger (day) VALUES (?)", (day,))
+            cur = self.db.execute(
+                "UPDATE quota_ledger SET units = units + ?, requests = requests + 1 WHERE day = ? AND units + ? <= ?",
+                (units, day, units, limit)
+            )
+        return cur.rowcount == 1
+
+class QuotaScheduler():
+    """
+    Shared gate every YouTube API request goes through (see get_scheduler)
+
+    Requests are charged against a persistent daily ledger and rate limited with a token bucket. Interactive
+    requests go before bulk ones and may use the whole quota. Once only reserve units are left, bulk requests 
+    are deferred until the quota resets (awaiting so no thread is tied up). If max_wait is set (YT_QUOTA_MAX_WAIT)
+    and the reset is further away than that, they fail with QuotaExceeded instead
+    """
+    def __init__(
+        self,
+        daily_quota: int = int(os.environ.get("YT_DAILY_QUOTA", 10000)),
+        reserve: int = int(os.environ.get("YT_QUOTA_RESERVE", 500)),
+        rate: float = 10,
+        burst: int = 20,
+        max_wait: float = float(os.environ.get("YT_QUOTA_MAX_WAIT", "inf")),
+        ledger: QuotaLedger = None
+    ):
+        self.daily_quota = daily_quota
+        self.reserve = reserve
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.ledger = ledger or QuotaLedger()
+        self.lock = threading.Lock() # Clients on different event loops (threads) share a scheduler
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.interactive_waiting = 0
+        self.deferred = 0 # Bulk requests waiting for the quota to reset
+
+    def _take_token(self, priority: Priority) -> float:
+        """Takes a token if one is free for this priority. Returns 0 on success or how long to wait otherwise"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            if self.tokens >= 1 and (priority == Priority.interactive or not self.interactive_waiting):
+                self.tokens -= 1
+                return 0
+            return max((1 - self.tokens) / self.rate, 0.01)
+
+    async def _rate_limit(self, priority: Priority):
+        waiting = False
+        try:
+            while True:
+                wait = self._take_token(priority)
+                if not wait:
+                    return
+                if priority == Priority.interactive and not waiting:
+                    waiting = True
+                    with self.lock:
+                        self.interactive_waiting += 1
+                await asyncio.sleep(wait)
+        finally:
+            if waiting:
+                with self.lock:
+                    self.interactive_waiting -= 1
+
+    async def acquire(self, endpoint: str, priority: Priority = Priority.bulk):
+        """Waits until a request to endpoint may be made and charges it to the ledger"""
+        cost = UNIT_COSTS.get(endpoint, DEFAULT_COST)
+        await self._rate_limit(priority)
+        # The ledger may wait on other processes holding the database lock so keep it off the event loop
+        if priority == Priority.interactive:
+            if not await asyncio.to_thread(self.ledger.charge, cost, self.daily_quota):
+                raise QuotaExceeded(f"YouTube quota of {self.daily_quota} units for {quota_day()} is used up")
+            return
+
+        while not await asyncio.to_thread(self.ledger.charge, cost, self.daily_quota - self.reserve):
+            wait = seconds_to_reset()
+            if wait > self.max_wait:
+                raise QuotaExceeded(f"YouTube quota for {quota_day()} is down to its reserve of {self.reserve} units, {endpoint} request not made")
+            print(f"WARNING: YouTube quota is down to its reserve, deferring {endpoint} request for {wait:.0f}s until the quota resets")
+            with self.lock:
+                self.deferred += 1
+            try:
+                await asyncio.sleep(wait + 1)
+            finally:
+                with self.lock:
+                    self.deferred -= 1
+
+    def report(self) -> dict:
+        used = self.ledger.used()
+        return {
+            "day": quota_day(),
+            "used": used,
+            "remaining": max(self.daily_quota - used, 0),
+            "daily_quota": self.daily_quota,
+            "reserve": self.reserve,
+            "deferred": self.deferred
+        }
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> QuotaScheduler:
+    """The scheduler shared by every client in this process"""
+    global _scheduler
+    with _scheduler_lock:
+        if not _scheduler:
+            _scheduler = QuotaScheduler()
+        return _scheduler
@@ -0,0 +1,173 @@
+"""
+Offline stand-in for the YouTube Data API that replays responses recorded in tmpstor
+
+Run with python3 -m sdk.fetcher.yt.replay [--fixtures tmpstor] [--port 8765] [--latency 0.05]
+and point a client at it with Youtube(api_url=..., credentials=ReplayCredentials())
+"""
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from aiohttp import web
+from sdk import common
+import argparse
+import asyncio
+import hashlib
+import random
+import sqlite3
+import msgpack
+
+# Endpoint to the cache type its responses are stored under and the parameter that is the cache id
+ENDPOINTS = {
+    "channels": ("channel", "id"),
+    "playlists": ("channelplaylists", "channelId"),
+    "playlistItems": ("playlistitem", "playlistId"),
+    "videos": ("video", "id"),
+}
+
+Fixtures = Dict[Tuple[str, str], List[dict]]
+
+class ReplayCredentials():
+    """Credentials that never need a refresh, the replay server does not check them"""
+    valid = True
+    token = "replay"
+
+def _pages(data: List[dict]) -> List[dict]:
+    return [page for page in data if not page.get("internal")]
+
+def load_fixtures(path: str) -> Fixtures:
+    """
+    Loads recorded responses keyed by (cache type, cache id) from either a directory of
+    cache-{type}-{id}.lynx files or a YoutubeCache SQLite database (stale responses included)
+    """
+    path = Path(path)
+    fixtures = {}
+    if path.is_dir():
+        for f in path.glob("cache-*.lynx"):
+            _, t, id = f.stem.split("-", 2)
+            fixtures[(t, id)] = _pages(common.read_min(f))
+        sqlite_path = path / "youtube.sqlite3"
+        if not sqlite_path.exists():
+            return fixtures
+        path = sqlite_path
+
+    db = sqlite3.connect(path)
+    try:
+        for t, id, data in db.execute("SELECT type, id, data FROM responses"):
+            fixtures.setdefault((t, id), _pages(msgpack.unpackb(data, strict_map_key=False)))
+    finally:
+        db.close()
+    return fixtures
+
+class ReplayServer():
+    """
+    Serves recorded responses the way the YouTube Data API would, including pagination,
+    If-None-Match and batched video ids. Every request is delayed by latency (plus up to jitter) seconds
+    """
+    def __init__(self, fixtures: Fixtures, latency: float = 0, jitter: float = 0, host: str = "127.0.0.1", port: int = 0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.host = host
+        self.port = port
+        self.stats = {"requests": Counter(), "not_modified": 0, "missing": []}
+        self.app = web.Application()
+        self.app.router.add_get("/{endpoint}", self.handle)
+        self.runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> str:
+        """Starts the server and returns its url"""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        # Pick up the port if a free one was asked for
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def reset_stats(self):
+        self.stats = {"requests": Counter(), "not_modified": 0, "missing": []}
+
+    def _error(self, status: int, message: str) -> web.Response:
+        return web.json_response({"error": {"code": status, "message": message}}, status=status)
+
+    def _videos(self, ids: List[str]) -> dict:
+        """A videos.list response for many ids, made from the recorded response of each video"""
+        items = []
+        for id in ids:
+            pages = self.fixtures.get(("video", id))
+            if not pages:
+                self.stats["missing"].append(f"video:{id}")
+                continue
+            items += pages[0]["items"]
+        etag = hashlib.md5("".join(item.get("etag", "") for item in items).encode()).hexdigest()
+        return {
+            "kind": "youtube#videoListResponse",
+            "etag": etag,
+            "items": items,
+            "pageInfo": {"totalResults": len(items), "resultsPerPage": len(items)}
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        endpoint = request.match_info["endpoint"]
+        self.stats["requests"][endpoint] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        if endpoint not in ENDPOINTS:
+            return self._error(404, f"Unknown endpoint {endpoint}")
+        t, param = ENDPOINTS[endpoint]
+        id = request.query.get(param)
+        if not id:
+            return self._error(400, f"Missing {param}")
+
+        if t == "video" and "," in id:
+            page = self._videos(id.split(","))
+        else:
+            pages = self.fixtures.get((t, id))
+            if pages is None:
+                if t == "video":
+                    # Like youtube, unknown videos are just left out
+                    page = self._videos([id])
+                else:
+                    self.stats["missing"].append(f"{t}:{id}")
+                    return self._error(404, f"No recorded {t} response for {id}")
+            else:
+                token = request.query.get("pageToken")
+                index = 0
+                if token:
+                    index = next((i + 1 for i, page in enumerate(pages) if page.get("nextPageToken") == token), None)
+                    if index is None or index >= len(pages):
+                        return self._error(400, f"Invalid page token {token}")
+                page = pages[index]
+
+        if page.get("etag") and request.headers.get("If-None-Match") == page["etag"]:
+            self.stats["not_modified"] += 1
+            return web.Response(status=304)
+        return web.json_response(page)
+
+async def serve(fixtures: str, host: str, port: int, latency: float, jitter: float):
+    server = ReplayServer(load_fixtures(fixtures), latency=latency, jitter=jitter, host=host, port=port)
+    url = await server.start()
+    print(f"Replaying {len(server.fixtures)} recorded responses on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays recorded YouTube Data API responses")
+    parser.add_argument("--fixtures", default="tmpstor", help="tmpstor directory or YoutubeCache database")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="Seconds every request is delayed by")
+    parser.add_argument("--jitter", type=float, default=0, help="Up to this many extra seconds of random delay")
+    args = parser.parse_args()
+    asyncio.run(serve(args.fixtures, args.host, args.port, args.latency, args.jitter))
@@ -1,71 +1,456 @@
 import os
+import sys
+import asyncio
+import contextlib
+import traceback
+import multiprocessing
 import shutil
 import pathlib
+import hashlib
+import json
+import time
 import uuid
+from io import StringIO
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Set
 from copy import deepcopy
-from sdk import common
+from concurrent.futures import ProcessPoolExecutor
+from sdk import common, precompress
+from sdk.build_profiler import BuildProfiler
 from sdk.fetcher import scrape, scrape_cache_clear
 import asyncpg
 import orjson
-import aiohttp
+import msgpack
 
 from sdk.fetcher.yt import Youtube
 
 if os.environ.get("HTTP_SCRAPE_MODE"):
     from sdk import video_crawler
 
-async def gen_info(db: asyncpg.Pool, yt: Youtube):
-    os.chdir("data")
-    if os.environ.get("HTTP_SCRAPE_MODE"):
-        session = video_crawler.prepare()
-    else:
-        session = None
+# Lynx version of chapter data, the small keystone files stay on v1 as shiksdk reads them too
+LYNX_VERSION = 2
 
-    # Basic setup
-    env = Environment(
-        loader=FileSystemLoader("templates/jinja2"),
-        autoescape=select_autoescape(),
-    )
+# Builds are made in builds/<build id> and published by pointing the build symlink at them
+BUILDS_DIR = "builds"
+LIVE_BUILD = "build"
 
-    env.globals = {"uuid_gen": lambda: str(uuid.uuid4())}
-    env.trim_blocks = True
-    env.lstrip_blocks = True
+# Builds otherwise change into data, this is for code that can run while a build is going on
+DATA_DIR = pathlib.Path("data").resolve()
 
-    shutil.rmtree("build", ignore_errors=True)
-    pathlib.Path("build/keystone").mkdir(parents=True)
+class BuildManifest():
+    """
+    Records the input hashes of every chapter and the hash of every other output of a build 
+    so an incremental build only rewrites what actually changed
 
-    boards_data = common.load_yaml("core/boards.yaml")
-    langs = common.load_yaml("core/langs.yaml")
-    sources = common.load_yaml("core/sources.yaml")
-    subjects_data = common.load_yaml("core/subjects.yaml")
-    index = common.load_yaml("core/index.yaml")
+    All paths are relative to the build directory (root) being written to
+    """
+    def __init__(self, incremental: bool, root: pathlib.Path, profiler: BuildProfiler = None):
+        self.incremental = incremental
+        self.root = pathlib.Path(root)
+        self.profiler = profiler or BuildProfiler()
+        self.path = self.root / "keystone" / "build_manifest.lynx"
+        self.old = {"chapters": {}, "outputs": {}}
+        self.new = {"chapters": {}, "outputs": {}}
 
-    boards_data = [board.lower() for board in boards_data]
+        if incremental and self.path.exists():
+            try:
+                self.old = common.read_min(self.path)
+            except Exception as exc:
+                print(f"WARNING: Could not read build manifest ({exc}), doing a full build")
+                self.incremental = False
+        elif incremental:
+            print("WARNING: No build manifest found, doing a full build")
+            self.incremental = False
+
+    def get_chapter(self, key: str, yaml_hash: str, global_hash: str, resource_hashes: Dict[str, str]) -> Optional[dict]:
+        """Returns the previous manifest entry of a chapter if none of its inputs have changed"""
+        if not self.incremental:
+            return None
+        old = self.old["chapters"].get(key)
+        if not old or not (self.root / old["build_dir"]).exists():
+            return None
+        if old["yaml"] != yaml_hash or old["global"] != global_hash:
+            return None
+        if old["resources"] != resource_hashes.get(old["listing"]["iname"], ""):
+            return None
+        return old
+
+    def set_chapter(self, key: str, entry: dict):
+        self.new["chapters"][key] = entry
+
+    def write_min(self, d, path: str, no_debug: bool = False, version: int = 1) -> bool:
+        """Same as common.write_min but skips the write if the output is unchanged. Returns whether it was written"""
+        digest = f"{common.hash_min(d)}-v{version}"
+        self.new["outputs"][path] = digest
+        if self.incremental and self.old["outputs"].get(path) == digest and (self.root / path).exists():
+            self.profiler.count("outputs_unchanged")
+            return False
+        self.profiler.write_min(d, self.root / path, no_debug=no_debug, version=version)
+        return True
+
+    def remove_stale(self):
+        """Removes chapters and outputs that the previous build made but this one did not"""
+        for key, old in self.old["chapters"].items():
+            if key not in self.new["chapters"]:
+                print(f"Removing stale chapter {key}")
+                shutil.rmtree(self.root / old["build_dir"], ignore_errors=True)
+        
+        for path in self.old["outputs"].keys():
+            if path not in self.new["outputs"]:
+                print(f"Removing stale output {path}")
+                for suffix in (".lynx", ".snowfall"):
+                    (self.root / path).with_suffix(suffix).unlink(missing_ok=True)
+
+    def save(self):
+        self.profiler.write_min(self.new, self.path, no_debug=True)
+
+def build_order(build: pathlib.Path) -> tuple:
+    """
+    Sort key of a build. Builds are named {sequence}_{UTC time} so the order does not depend on the clock. 
+    Builds named by local time (from before the sequence was used) sort before them, by name
+    """
+    sequence, sep, _ = build.name.partition("_")
+    if sep and sequence.isdigit():
+        return (1, int(sequence), build.name)
+    return (0, 0, build.name)
+
+def new_staging_dir(incremental: bool, root: pathlib.Path = pathlib.Path(".")) -> pathlib.Path:
+    """Creates the directory a build is written to, starting from a copy of the live build if incremental"""
+    pathlib.Path(root, BUILDS_DIR).mkdir(parents=True, exist_ok=True)
+    sequence = max((order[1] for order in map(build_order, list_builds(root))), default=0)
+    while True:
+        sequence += 1
+        staging = pathlib.Path(root, BUILDS_DIR, f"{sequence:06d}_{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}")
+        try:
+            # Both fail if another build took this sequence number first
+            if incremental and pathlib.Path(root, LIVE_BUILD).exists():
+                shutil.copytree(os.path.realpath(pathlib.Path(root, LIVE_BUILD)), staging)
+            else:
+                staging.mkdir()
+        except FileExistsError:
+            continue
+        return staging
+
+def list_builds(root: pathlib.Path = pathlib.Path(".")) -> List[pathlib.Path]:
+    """Returns all builds in root, oldest first"""
+    builds_dir = pathlib.Path(root, BUILDS_DIR)
+    if not builds_dir.is_dir():
+        return []
+    return sorted((path for path in builds_dir.iterdir() if path.is_dir()), key=build_order)
+
+def live_build(root: pathlib.Path = pathlib.Path(".")) -> Optional[pathlib.Path]:
+    link = pathlib.Path(root, LIVE_BUILD)
+    if not link.is_symlink():
+        return None
+    return pathlib.Path(root, BUILDS_DIR, pathlib.Path(os.readlink(link)).name)
+
+def publish_build(build: pathlib.Path, root: pathlib.Path = pathlib.Path(".")):
+    """Atomically points the live build symlink in root at a build"""
+    live = pathlib.Path(root, LIVE_BUILD)
+    if live.is_dir() and not live.is_symlink():
+        # Build directory from before staging was used, move it out of the way once
+        legacy = pathlib.Path(root, BUILDS_DIR, "00000000-000000-legacy")
+        shutil.rmtree(legacy, ignore_errors=True)
+        os.rename(live, legacy)
+
+    tmp_link = pathlib.Path(root, f"{LIVE_BUILD}.tmp-{uuid.uuid4().hex[:8]}")
+    # The link is relative to root so the data directory can be moved
+    os.symlink(os.path.relpath(build, root), tmp_link)
+    os.replace(tmp_link, live)
+    print(f"Published build {build.name}")
+
+def prune_builds(keep: int, root: pathlib.Path = pathlib.Path(".")):
+    """Removes all but the live build and the keep most recent builds before it"""
+    live = live_build(root)
+    builds = [build for build in list_builds(root) if build != live]
+    if live:
+        # Never prune builds newer than the live one (such as one that was just rolled back from)
+        older = [build for build in builds if build_order(build) < build_order(live)]
+    else:
+        older = builds
+    for build in older[:max(len(older) - keep, 0)]:
+        print(f"Removing old build {build.name}")
+        shutil.rmtree(build, ignore_errors=True)
+
+def rollback_build() -> Optional[str]:
+    """
+    Points the live build symlink at the build before the live one. Returns the build now live
+
+    Uses DATA_DIR instead of changing directory as a build may be running in another thread
+    """
+    live = live_build(DATA_DIR)
+    older = [build for build in list_builds(DATA_DIR) if not live or build_order(build) < build_order(live)]
+    if not older:
+        return None
+    publish_build(older[-1], DATA_DIR)
+    return older[-1].name
+
+def hash_file(path) -> str:
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+def hash_templates() -> str:
+    h = hashlib.sha256()
+    for template in sorted(pathlib.Path("templates/jinja2").rglob("*")):
+        if template.is_file():
+            h.update(str(template).encode("utf-8"))
+            h.update(template.read_bytes())
+    return h.hexdigest()
+
+def get_global_hash() -> str:
+    """Hash of anything that affects every chapter"""
+    return hashlib.sha256(
+        common.hash_min(common.create_resource_type_list()).encode("utf-8") 
+        + hash_templates().encode("utf-8") 
+        + str(LYNX_VERSION).encode("utf-8")
+    ).hexdigest()
+
+async def get_resource_hashes(db: asyncpg.Pool, grade: int, board: str, subject: str) -> Dict[str, str]:
+    """Returns a hash of all resource rows of a subject grouped by chapter iname"""
+    rows = await db.fetch(
+        "SELECT chapter_iname, md5(string_agg(t::text, ',' ORDER BY t.resource_id)) AS hash FROM topic_resources t WHERE grade = $1 AND board = $2 AND subject = $3 GROUP BY chapter_iname",
+        grade,
+        board,
+        subject
+    )
+    return {row["chapter_iname"]: row["hash"] for row in rows}
+
+# Columns (in order) of a resource in the resources-{topic}-{subtopic}.lynx files
+RESOURCE_COLUMNS = (
+    "resource_url", 
+    "resource_title", 
+    "resource_type", 
+    "resource_id", 
+    "resource_author", 
+    "resource_metadata", 
+    "resource_description", 
+    "resource_icon", 
+    "resource_lang"
+)
+
+async def fetch_subject_resources(db: asyncpg.Pool, grade: int, board: str, subject: str) -> Dict[str, Dict[tuple, List[asyncpg.Record]]]:
+    """
+    Fetches all enabled resources of a subject in one query and groups them by 
+    chapter iname and then by (topic_iname, subtopic_parent)
+
+    The view count ordering of the query is preserved within each group
+    """
+    rows = await db.fetch(
+        f"SELECT chapter_iname, topic_iname, subtopic_parent, {', '.join(RESOURCE_COLUMNS)} FROM topic_resources WHERE grade = $1 AND board = $2 AND subject = $3 AND disabled = false ORDER BY resource_metadata['view_count']",
+        grade,
+        board,
+        subject
+    )
 
-    with open("build/keystone/sources.lynx", "wb") as sources_fp:
-        common.write_min(sources, sources_fp)
+    grouped: Dict[str, Dict[tuple, List[asyncpg.Record]]] = {}
+    for row in rows:
+        grouped.setdefault(row["chapter_iname"], {}).setdefault((row["topic_iname"], row["subtopic_parent"]), []).append(row)
+    return grouped
+
+# Rows packed before a resource dump is written out
+RESOURCE_DUMP_BATCH = 1000
+
+class ResourceDumpWriter():
+    """Writes a msgpack array of count rows to a keystone file in chunks, hashing it for the build manifest"""
+    def __init__(self, manifest: BuildManifest, path: str, count: int, grade: int = None):
+        self.manifest = manifest
+        self.path = path
+        self.grade = grade
+        self.fp = (manifest.root / path).open("wb")
+        self.packer = msgpack.Packer()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.buffer = bytearray(self.packer.pack_array_header(count))
+        self.rows = 0
+
+    def add(self, row: dict):
+        self.buffer += self.packer.pack(row)
+        self.rows += 1
+        if self.rows % RESOURCE_DUMP_BATCH == 0:
+            self.flush()
+
+    def flush(self):
+        self.hash.update(self.buffer)
+        self.fp.write(self.buffer)
+        self.size += len(self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+        self.manifest.new["outputs"][self.path] = f"{self.hash.hexdigest()}-v1"
+        self.manifest.profiler.count("files_written")
+        self.manifest.profiler.count("bytes_written", self.size)
+
+async def write_resources_keystone(db: asyncpg.Pool, manifest: BuildManifest, shard: bool = False):
+    """
+    Streams every resource straight from the database into keystone/resources.lynx 
+    (or keystone/resources-{grade}.lynx for each grade if shard is set)
+
+    Rows are packed as they come off a cursor so the table is never held in memory. The dump is 
+    lynx v1 as v2 needs every row up front for its string table
+    """
+    profiler = manifest.profiler
+    async with db.acquire() as conn:
+        # One snapshot so the counts match the rows that are streamed
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            with profiler.phase("postgres"):
+                if shard:
+                    counts = {row["grade"]: row["count"] for row in await conn.fetch("SELECT grade, COUNT(*) FROM topic_resources GROUP BY grade")}
+                else:
+                    counts = {None: await conn.fetchval("SELECT COUNT(*) FROM topic_resources")}
+            profiler.count("queries")
+
+            writer = None
+            if not shard:
+                writer = ResourceDumpWriter(manifest, "keystone/resources.lynx", counts[None])
+            try:
+                with profiler.phase("resources"):
+                    async for row in conn.cursor("SELECT * FROM topic_resources ORDER BY grade, resource_id", prefetch=RESOURCE_DUMP_BATCH):
+                        if shard and (not writer or writer.grade != row["grade"]):
+                            if writer:
+                                writer.close()
+                            writer = ResourceDumpWriter(manifest, f"keystone/resources-{row['grade']}.lynx", counts[row["grade"]], row["grade"])
+                        row = dict(row)
+                        row["resource_id"] = str(row["resource_id"])
+                        writer.add(row)
+                        profiler.count("rows")
+            finally:
+                if writer:
+                    writer.close()
+
+async def crawl_resources(chapter_resources: Dict[tuple, List[asyncpg.Record]], profiler: BuildProfiler) -> Dict[str, Optional[dict]]:
+    """
+    In HTTP_SCRAPE_MODE, crawls the pages of every non youtube resource of a chapter at once (with Selenium if it is js). 
+    Returns a map of url to crawled page
+    """
+    mode = os.environ.get("HTTP_SCRAPE_MODE")
+    if not mode:
+        return {}
+    urls = {res["resource_url"] for rows in chapter_resources.values() for res in rows if "youtube.com" not in res["resource_url"]}
+    if not urls:
+        return {}
+    with profiler.phase("crawl"):
+        crawled = await video_crawler.get_crawler().crawl(sorted(urls), js=mode.lower() == "js")
+    profiler.count("pages_crawled", len(urls))
+    return crawled
+
+async def build_subject(
+    db: asyncpg.Pool, 
+    yt: Youtube, 
+    manifest: BuildManifest, 
+    global_hash: str, 
+    path: pathlib.Path, 
+    grade: int, 
+    board: str, 
+    subject: str
+) -> Dict[int, dict]:
+    """Builds all chapters of a subject, returning its chapter listing"""
+    profiler = manifest.profiler
+    chapter_listing: Dict[int, dict] = {}
+
+    with profiler.phase("postgres"):
+        resource_hashes = await get_resource_hashes(db, grade, board, subject)
+    profiler.count("queries")
+    profiler.count("rows", len(resource_hashes))
+    subject_resources = None # Only fetched once a chapter actually needs rebuilding
+
+    for chapter in path.iterdir():
+        if not chapter.is_dir():
+            continue
 
-    with open("build/keystone/subjects.lynx", "wb") as subjects_fp:
-        common.write_min(subjects_data, subjects_fp)
+        try:
+            chapter_num = int(chapter.name)
+        except ValueError:
+            print(f"WARNING: Invalid chapter {chapter.name}")
+            continue
+
+        build_chapter_dir = manifest.root / chapter
+
+        yaml_hash = hash_file(chapter / "info.yaml")
 
-    with open("build/keystone/boards.lynx", "wb") as boards_fp:
-        common.write_min(boards_data, boards_fp)
+        old = manifest.get_chapter(str(chapter), yaml_hash, global_hash, resource_hashes)
+        if old:
+            print(f"Chapter {chapter.name} is unchanged, skipping")
+            chapter_listing[chapter_num] = old["listing"]
+            manifest.set_chapter(str(chapter), old)
+            profiler.count("chapters_skipped")
+            continue
+        
+        print(f"Adding chapter {chapter.name}")
+        chapter_start = time.perf_counter()
 
-    with open("build/keystone/langs.lynx", "wb") as langs_fp:
-        common.write_min(langs, langs_fp)
+        # Chapter handling begins here
+        with profiler.phase("yaml"):
+            chapter_info = common.load_yaml(chapter / "info.yaml", ruamel_type="rt")
+
+        chapter_info["subject"] = subject
+        chapter_info["grade"] = grade
+        chapter_info["board"] = board
+
+        chapter_listing[chapter_num] = {"name": chapter_info["name"], "iname": chapter_info["iname"]}
+
+        shutil.rmtree(build_chapter_dir, ignore_errors=True)
+        build_chapter_dir.mkdir(parents=True)
+
+        if subject_resources is None:
+            with profiler.phase("postgres"):
+                subject_resources = await fetch_subject_resources(db, grade, board, subject)
+            profiler.count("queries")
+            profiler.count("rows", sum(len(rows) for groups in subject_resources.values() for rows in groups.values()))
+
+        # Parse all the topics
+        chapter_resources = subject_resources.get(chapter_info["iname"], {})
+        crawled = await crawl_resources(chapter_resources, profiler)
+        bundle_resources: Dict[str, dict] = {}
+        for topic in chapter_info["topics"]:
+            chapter_info["topics"] = await parse_topic(chapter_resources, yt, chapter_info, topic, build_chapter_dir, bundle_resources, profiler, crawled)
+
+        # Write info
+        profiler.write_min(chapter_info, build_chapter_dir / "info.lynx", version=LYNX_VERSION)
+
+        # Everything the chapter page needs in one request
+        profiler.write_min({
+            "info": chapter_info,
+            "resource_types": common.create_resource_type_list(),
+            "resources": bundle_resources
+        }, build_chapter_dir / "bundle.lynx", no_debug=True, version=LYNX_VERSION)
+        
+        manifest.set_chapter(str(chapter), {
+            "yaml": yaml_hash,
+            "global": global_hash,
+            "resources": resource_hashes.get(chapter_info["iname"], ""),
+            "build_dir": str(chapter),
+            "listing": chapter_listing[chapter_num]
+        })
+
+        profiler.count("chapters_built")
+        profiler.add_chapter(str(chapter), time.perf_counter() - chapter_start)
+
+        scrape_cache_clear()
     
-    with open("build/keystone/index.lynx", "wb") as index_fp:
-        common.write_min(index, index_fp)
+    return chapter_listing
+
+async def build_grades(
+    db: asyncpg.Pool, 
+    yt: Optional[Youtube], 
+    manifest: BuildManifest, 
+    global_hash: str, 
+    boards_data: List[str], 
+    subjects_data: dict, 
+    concurrency: int = None,
+    only_grade: str = None
+) -> dict:
+    """
+    Builds all chapters and chapter listings of every grade (or only one grade if only_grade is set)
     
-    with open("build/keystone/resource_types.lynx", "wb") as enums_fp:
-        common.write_min(common.create_resource_type_list(), enums_fp)
-
-    # Create grades
+    Returns the partial output needed to build the keystone files
+    """
     grades: set = set()
     grade_boards: Dict[int, Set[str]] = {}
     subject_list: Dict[int, Set[str]] = {}
+    board_subject_lists: Dict[tuple, List[str]] = {}
+    subject_paths: List[tuple] = []
 
     for path in pathlib.Path("grades").rglob("*/*/*"):
         if path.is_file():
@@ -74,10 +459,13 @@ async def gen_info(db: asyncpg.Pool, yt: Youtube):
         if len(path.parts) != 4:
             continue
 
-        print(path)
-
         _, grade, board, subject = path.parts
 
+        if only_grade is not None and grade != only_grade:
+            continue
+
+        print(path)
+
         try:
             grade = int(grade)
         except ValueError:
@@ -110,85 +498,286 @@ async def gen_info(db: asyncpg.Pool, yt: Youtube):
 
         print(f"Found subject {subject} in board {board.upper()} of grade {grade}")
 
-        chapter_listing: Dict[int, int] = {}
+        subject_paths.append((path, grade, board, subject))
+        board_subject_lists[(grade, board)] = sorted(subject_list[grade])
+
+    # Subjects are built concurrently, bounded by the pool size so we never wait on a connection
+    if not concurrency:
+        concurrency = db.get_max_size()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _bounded_build_subject(path: pathlib.Path, grade: int, board: str, subject: str):
+        async with sem:
+            return await build_subject(db, yt, manifest, global_hash, path, grade, board, subject)
+
+    tasks = [asyncio.ensure_future(_bounded_build_subject(*args)) for args in subject_paths]
+    try:
+        chapter_listings = await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other subjects before the staging directory they write to is removed
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    chapter_lists: Dict[tuple, dict] = {}
+    for (_, grade, board, subject), chapter_listing in zip(subject_paths, chapter_listings):
+        chapter_lists[(grade, board, subject)] = chapter_listing
+        (manifest.root / "grades" / str(grade) / board / subject).mkdir(parents=True, exist_ok=True)
+        manifest.write_min(chapter_listing, os.path.join("grades", str(grade), board, subject, "chapter_list.lynx"), version=LYNX_VERSION)
+
+    return {
+        "grades": list(grades),
+        "grade_boards": {k: list(v) for k, v in grade_boards.items()},
+        "board_subject_lists": board_subject_lists,
+        "chapter_lists": chapter_lists
+    }
+
+class ShardError(Exception):
+    """A shard worker failed. args are the message, the stdout and the stderr (with traceback) of the worker"""
+
+def build_shard(grade: str, incremental: bool, root: str, data_dir: str) -> dict:
+    """
+    Entry point of a shard worker process. Builds one grade using its own database pool
+
+    Output is captured and returned (or raised in a ShardError) so it ends up in the build log of the parent
+    """
+    os.chdir(data_dir)
+    out = StringIO()
+    err = StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            partial = asyncio.run(_build_shard(grade, incremental, root))
+        except BaseException as exc:
+            traceback.print_exc()
+            raise ShardError(f"Building grade {grade} failed: {exc!r}", out.getvalue(), err.getvalue()) from None
+    partial["log"] = (out.getvalue(), err.getvalue())
+    return partial
+
+async def _build_shard(grade: str, incremental: bool, root: str) -> dict:
+    boards_data = [board.lower() for board in common.load_core("boards")]
+    subjects_data = common.load_core("subjects")
+
+    global_hash = get_global_hash()
+
+    # The parent process has already made the staging directory
+    manifest = BuildManifest(incremental, root)
+
+    db = await asyncpg.create_pool()
+    try:
+        partial = await build_grades(db, None, manifest, global_hash, boards_data, subjects_data, only_grade=grade)
+    finally:
+        await db.close()
+        if os.environ.get("HTTP_SCRAPE_MODE"):
+            await video_crawler.close_crawler()
+    
+    partial["manifest"] = manifest.new
+    partial["profile"] = manifest.profiler.report()
+    return partial
+
+async def build_sharded(manifest: BuildManifest, processes: int) -> List[dict]:
+    """Builds every grade in its own worker process, returning the partial output of each shard"""
+    shard_grades = [grade.name for grade in pathlib.Path("grades").iterdir() if grade.is_dir()]
+    print(f"Building grades {shard_grades} over {processes} processes")
+
+    loop = asyncio.get_running_loop()
+
+    # Workers change into the data directory themselves as this process may be serving other requests
+    data_dir = os.path.abspath(".")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [loop.run_in_executor(executor, build_shard, grade, manifest.incremental, str(manifest.root), data_dir) for grade in shard_grades]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+
+    for grade, result in zip(shard_grades, results):
+        if isinstance(result, ShardError):
+            _, out, err = result.args
+        elif isinstance(result, BaseException):
+            out, err = "", f"{result!r}\n"
+        else:
+            out, err = result.pop("log")
+        print(f"Output of grade {grade} shard:\n{out}", end="")
+        sys.stderr.write(err)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+async def gen_info(
+    db: asyncpg.Pool, 
+    yt: Youtube, 
+    incremental: bool = False, 
+    concurrency: int = None, 
+    processes: int = None, 
+    keep: int = 1,
+    shard_resources: bool = False
+):
+    """
+    Builds the data needed for the client to run
+    
+    If incremental is set, only chapters whose info.yaml, resources or templates 
+    changed since the last build (as per the build manifest) are regenerated
 
-        for chapter in path.iterdir():
-            if not chapter.is_dir():
-                continue
-            
-            print(f"Adding chapter {chapter.name}")
+    Up to concurrency subjects (defaulting to the pool size) are built at the same time
 
-            # Chapter handling begins here
-            chapter_info = common.load_yaml(chapter / "info.yaml", ruamel_type="rt")
+    If processes is more than 1, every grade is built in a separate worker process and 
+    the keystone files are then made from the output of all the shards
 
-            chapter_info["subject"] = subject
-            chapter_info["grade"] = grade
-            chapter_info["board"] = board
+    The build is made in a staging directory and only published (by atomically flipping 
+    the build symlink) once it succeeds. keep previous builds are kept around for rollbacks
 
-            try:
-                chapter_listing[int(chapter.name)] = {"name": chapter_info["name"], "iname": chapter_info["iname"]}
-            except ValueError:
-                print(f"WARNING: Invalid chapter {chapter.name}")
-                continue
+    The raw resource dump is streamed from the database into keystone/resources.lynx 
+    or, if shard_resources is set, into one keystone/resources-{grade}.lynx per grade
 
-            build_chapter_dir = pathlib.Path(str(chapter).replace("grades", "build/grades", 1))
-            build_chapter_dir.mkdir(parents=True)
+    Every artifact also gets gzip/brotli/zstd sidecars (see sdk.precompress)
 
-            # Parse all the topics
-            for topic in chapter_info["topics"]:
-                chapter_info["topics"] = await parse_topic(db, yt, chapter_info, topic, build_chapter_dir)
+    Timings of every phase and chapter are written to keystone/build_report.json
+    """
+    os.chdir("data")
 
-            # Write info
-            with (build_chapter_dir / "info.lynx").open("w") as chapter_info_json:
-                common.write_min(chapter_info, chapter_info_json)
-            
-            scrape_cache_clear()
-        
-        with open(os.path.join("build", "grades", str(grade), board, subject, "chapter_list.lynx"), "w") as chapter_listing_fp:
-            common.write_min(chapter_listing, chapter_listing_fp)
+    # Basic setup
+    env = Environment(
+        loader=FileSystemLoader("templates/jinja2"),
+        autoescape=select_autoescape(),
+    )
+
+    env.globals = {"uuid_gen": lambda: str(uuid.uuid4())}
+    env.trim_blocks = True
+    env.lstrip_blocks = True
+
+    staging = new_staging_dir(incremental)
+    manifest = BuildManifest(incremental, staging)
+    print(f"Building into {staging}")
+
+    try:
+        await _gen_info(db, yt, env, manifest, concurrency, processes, shard_resources)
+
+        print("Precompressing build")
+        with manifest.profiler.phase("precompress"):
+            compression = await asyncio.to_thread(precompress.precompress, str(staging))
+
+        report = manifest.profiler.report() | {"compression": compression}
+        with (staging / "keystone" / "build_report.json").open("w") as report_fp:
+            json.dump(report, report_fp, indent=4)
+        print(manifest.profiler.summary())
+    except BaseException:
+        print(f"WARNING: Build failed, removing {staging}. The live build has not been changed")
+        shutil.rmtree(staging, ignore_errors=True)
+        if os.getcwd().endswith("data"):
+            os.chdir("..")
+        raise
+    finally:
+        if os.environ.get("HTTP_SCRAPE_MODE"):
+            # The crawler (and its browsers) only start if something was crawled
+            await video_crawler.close_crawler()
+
+    publish_build(staging)
+    prune_builds(keep)
+
+    if os.getcwd().endswith("data"):
+        os.chdir("..")
 
-        with open(os.path.join("build", "grades", str(grade), board, "subject_list.lynx"), "w") as subject_list_fp:  
-            common.write_min(list(subject_list[grade]), subject_list_fp)
+async def _gen_info(
+    db: asyncpg.Pool, 
+    yt: Youtube, 
+    env: Environment, 
+    manifest: BuildManifest, 
+    concurrency: int, 
+    processes: int, 
+    shard_resources: bool
+):
+    (manifest.root / "keystone").mkdir(parents=True, exist_ok=True)
+
+    global_hash = get_global_hash()
+
+    with manifest.profiler.phase("yaml"):
+        boards_data = common.load_core("boards")
+        langs = common.load_core("langs")
+        sources = common.load_core("sources")
+        subjects_data = common.load_core("subjects")
+        index = common.load_core("index")
+
+    boards_data = [board.lower() for board in boards_data]
+
+    manifest.write_min(sources, "keystone/sources.lynx")
+    manifest.write_min(subjects_data, "keystone/subjects.lynx")
+    manifest.write_min(boards_data, "keystone/boards.lynx")
+    manifest.write_min(langs, "keystone/langs.lynx")
+    manifest.write_min(index, "keystone/index.lynx")
+    manifest.write_min(common.create_resource_type_list(), "keystone/resource_types.lynx")
+
+    if processes and processes > 1:
+        partials = await build_sharded(manifest, processes)
+    else:
+        partials = [await build_grades(db, yt, manifest, global_hash, boards_data, subjects_data, concurrency)]
+
+    # Merge the partial outputs of every shard
+    grades: set = set()
+    grade_boards: Dict[int, Set[str]] = {}
+    board_subject_lists: Dict[tuple, List[str]] = {}
+    chapter_lists: Dict[tuple, dict] = {}
+    for partial in partials:
+        grades |= set(partial["grades"])
+        for grade, boards in partial["grade_boards"].items():
+            grade_boards.setdefault(grade, set()).update(boards)
+        board_subject_lists |= partial["board_subject_lists"]
+        chapter_lists |= partial["chapter_lists"]
+        if partial.get("manifest"):
+            manifest.new["chapters"] |= partial["manifest"]["chapters"]
+            manifest.new["outputs"] |= partial["manifest"]["outputs"]
+        if partial.get("profile"):
+            manifest.profiler.merge(partial["profile"])
+
+    for (grade, board), subjects in board_subject_lists.items():
+        manifest.write_min(subjects, os.path.join("grades", str(grade), board, "subject_list.lynx"))
 
     grades: list = list(grades)
     grades.sort()
 
-    grade_boards = {k: list(v) for k, v in grade_boards.items()}
+    grade_boards = {k: sorted(v) for k, v in grade_boards.items()}
 
     # Add in grade info from recorded data
-    with open("build/keystone/grade_info.lynx", "w") as grades_file:
-        common.write_min({
-                "grades": grades,
-                "grade_boards": grade_boards
+    manifest.write_min({
+            "grades": grades,
+            "grade_boards": grade_boards
         },
-        grades_file)
+        "keystone/grade_info.lynx"
+    )
     
     # Add in raw resource data for debug purposes
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get("http://127.0.0.1:8000/topics/resources?internal_http_call=true") as res:
-            resources = await res.json()
-    with open("build/keystone/resources.lynx", "wb") as resources_fp:
-        common.write_min(resources, resources_fp, no_debug=True)
+    await write_resources_keystone(db, manifest, shard_resources)
 
     # Compile the HTML
     print("Compiling HTML")
     grades_list = env.get_template("grades_list.jinja2")
     subject_base_accordian = env.get_template("subject_base_accordian.jinja2")
-    with open("build/keystone/html-grades_list.lynx", "w") as keystone:
-        common.write_min({
+    with manifest.profiler.phase("jinja"):
+        grades_html = {
             "en": common.remove_ws(grades_list.render(grades=grades, grade_boards=grade_boards, boards=boards_data, lang="en")),
             "hi": common.remove_ws(grades_list.render(grades=grades, grade_boards=grade_boards, boards=boards_data, lang="hi"))
-        }, keystone, no_debug=True)
+        }
+    manifest.write_min(grades_html, "keystone/html-grades_list.lynx", no_debug=True)
     for grade in grades:
         per_grade_subjects = get_per_grade_subjects(grade, subjects_data)
-        with open(f"build/grades/{grade}/html-subject_base_accordian.lynx", "w") as keystone:
-            common.write_min({
+        with manifest.profiler.phase("jinja"):
+            subject_html = {
                 "en": common.remove_ws(subject_base_accordian.render(subjects=per_grade_subjects, grade=grade, lang="en")),
                 "hi": common.remove_ws(subject_base_accordian.render(subjects=per_grade_subjects, grade=grade, lang="hi")),
-            }, keystone, no_debug=True)
-
-    if os.getcwd().endswith("data"):
-        os.chdir("..")
+            }
+        manifest.write_min(subject_html, f"grades/{grade}/html-subject_base_accordian.lynx", no_debug=True)
+
+        # Everything the learn page needs in one request
+        learn_chapter_lists: Dict[str, dict] = {}
+        for (_grade, board, subject), chapter_listing in chapter_lists.items():
+            if _grade == grade:
+                learn_chapter_lists.setdefault(board, {})[subject] = chapter_listing
+        manifest.write_min({
+            "html": subject_html,
+            "chapter_lists": learn_chapter_lists
+        }, f"grades/{grade}/learn_bundle.lynx", no_debug=True, version=LYNX_VERSION)
+
+    manifest.remove_stale()
+    manifest.save()
 
 def get_per_grade_subjects(grade: int, subjects_data: dict):
     subjects = {}
@@ -206,7 +795,24 @@ def get_per_grade_subjects(grade: int, subjects_data: dict):
         subjects[_subject] = subjects_data[_subject]
     return subjects
 
-async def parse_topic(db: asyncpg.Pool, yt: Youtube, chapter_info: dict, topic: str, build_chapter_dir: pathlib.Path):
+async def parse_topic(
+    chapter_resources: Dict[tuple, List[asyncpg.Record]], 
+    yt: Youtube, 
+    chapter_info: dict, 
+    topic: str, 
+    build_chapter_dir: pathlib.Path,
+    bundle_resources: Dict[str, dict],
+    profiler: BuildProfiler,
+    crawled: Dict[str, Optional[dict]] = None
+):
+    """
+    chapter_resources is the chapter's entry in the output of fetch_subject_resources
+
+    The resources of the topic and its subtopics are also added to bundle_resources (keyed by topic-subtopic)
+
+    crawled is the output of crawl_resources. The title of a crawled page is added to its resources as page_title
+    """
+    crawled = crawled or {}
     # Fix and add proper reject stuff
     if chapter_info["topics"][topic].get("reject") is None:
         chapter_info["topics"][topic]["reject"] = []
@@ -220,35 +826,23 @@ async def parse_topic(db: asyncpg.Pool, yt: Youtube, chapter_info: dict, topic:
     if chapter_info["topics"][topic].get("name", "$name") == "$name":
         chapter_info["topics"][topic]["name"] = chapter_info["name"]
     
-    async def resource_parse(topic, subtopic_parent):
-        def sort_by_view_count(d):
-            return d["view_count"]
-
-        sql = "SELECT resource_url, resource_title, resource_type, resource_id, resource_author, resource_metadata, resource_description, resource_icon, resource_lang FROM topic_resources WHERE grade = $1 AND board = $2 AND subject = $3 AND chapter_iname = $4 AND topic_iname = $5 "
-
-        args = [chapter_info["grade"], chapter_info["board"], chapter_info["subject"], chapter_info["iname"], topic]
-
-        if subtopic_parent:
-            sql += " AND subtopic_parent = $6"
-            args.append(subtopic_parent)
-        else:
-            sql += " AND NOT subtopic_parent <> ''"
-
-        sql += " AND disabled = false ORDER BY resource_metadata['view_count']"
-
-        resources = await db.fetch(sql, *args)
+    def resource_parse(topic, subtopic_parent):
+        resources = chapter_resources.get((topic, subtopic_parent or ""), [])
         print(f"Parsing resource {resources} for topic {topic} and subtopic_parent {subtopic_parent}")
 
-
         dat_f = {k: [] for k in [r.value for r in list(common.Resource)]}
         dat = []
 
         taken_pos = {}
         for i, res in enumerate(resources):
-            dat.append(dict(res))
+            dat.append({k: res[k] for k in RESOURCE_COLUMNS})
             dat[-1]["resource_id"] = str(dat[-1]["resource_id"])
             dat[-1]["resource_metadata"] = orjson.loads(dat[-1]["resource_metadata"])
 
+            page = crawled.get(dat[-1]["resource_url"])
+            if page and page.get("title"):
+                dat[-1]["resource_metadata"]["page_title"] = page["title"].strip()
+
             pos = dat[-1]["resource_metadata"].get("override_pos", 1)
 
             # 0, 1, 2, 3, 4, 5, 6, 7, 8 O-> 6, 9, 10
@@ -274,14 +868,16 @@ async def parse_topic(db: asyncpg.Pool, yt: Youtube, chapter_info: dict, topic:
         return dat_f
     
     # Main topic resources
-    main = await resource_parse(topic, None)
-    with (build_chapter_dir / f"resources-{topic}-main.lynx").open("wb") as res_json:
-        common.write_min(main, res_json)
+    with profiler.phase("resources"):
+        main = resource_parse(topic, None)
+    bundle_resources[f"{topic}-main"] = main
+    profiler.write_min(main, build_chapter_dir / f"resources-{topic}-main.lynx", version=LYNX_VERSION)
 
     for subtopic in deepcopy(chapter_info["topics"][topic]["subtopics"]):            
-        subtopic_res = await resource_parse(subtopic, topic)
-        with (build_chapter_dir / f"resources-{topic}-{subtopic}.lynx").open("wb") as res_json:
-            common.write_min(subtopic_res, res_json)
+        with profiler.phase("resources"):
+            subtopic_res = resource_parse(subtopic, topic)
+        bundle_resources[f"{topic}-{subtopic}"] = subtopic_res
+        profiler.write_min(subtopic_res, build_chapter_dir / f"resources-{topic}-{subtopic}.lynx", version=LYNX_VERSION)
 
 
     #if yt:
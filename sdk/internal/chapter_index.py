@@ -0,0 +1,76 @@
+"""In-memory index of built chapters for GET /chapters"""
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from sdk import common
+import hashlib
+import os
+import threading
+
+ChapterKey = Tuple[str, str, str, str] # grade, board, subject, chapter
+
+class ChapterIndex():
+    """
+    The info.lynx of every chapter in the live build keyed by grade/board/subject/chapter
+
+    Loaded on first use and reloaded after invalidate() (called when a build finishes or a chapter
+    YAML is written) or when the live build changes under us (such as a build from another process)
+    """
+    # Absolute by default as builds change into data while the index may be reloaded
+    def __init__(self, grades: Path = common.DATA_DIR / "grades", build: Path = common.DATA_DIR / "build"):
+        self.grades = Path(grades)
+        self.build = Path(build)
+        self.lock = threading.Lock()
+        self.chapters: Optional[Dict[ChapterKey, Optional[dict]]] = None
+        self.loaded_build: Optional[str] = None
+        self.generation = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.chapters = None
+            self.generation += 1
+
+    def _load(self):
+        chapters = {}
+        for path in sorted(self.grades.glob("*/*/*/*/info.yaml")):
+            key = path.parts[-5:-1]
+            try:
+                data = common.read_min(self.build / "grades" / Path(*key) / "info.lynx")
+            except FileNotFoundError:
+                # Not built yet
+                chapters[key] = None
+                continue
+
+            if "study-time" in data:
+                data["study_time"] = data.pop("study-time")
+            chapters[key] = data
+        self.chapters = chapters
+
+    def _get(self) -> Dict[ChapterKey, Optional[dict]]:
+        build = os.path.realpath(self.build)
+        with self.lock:
+            if self.chapters is None or build != self.loaded_build:
+                self._load()
+                self.loaded_build = build
+            return self.chapters
+
+    def query(self, grade: int = None, board: str = None, subject: str = None, chapter: int = None) -> List[dict]:
+        """Returns the chapters matching every filter that is set. Raises FileNotFoundError if one has not been built"""
+        chapters = self._get()
+        filters = (grade, board, subject, chapter)
+        if all(filters):
+            key = tuple(str(f) for f in filters)
+            matches = [chapters[key]] if key in chapters else []
+        else:
+            matches = [
+                data for key, data in chapters.items()
+                if all(not f or str(f) == part for f, part in zip(filters, key))
+            ]
+        if any(data is None for data in matches):
+            raise FileNotFoundError("Chapter has not been built")
+        return matches
+
+    def etag(self, *filters) -> str:
+        """ETag of a query, changes whenever the index is reloaded"""
+        self._get()
+        tag = hashlib.md5(f"{self.loaded_build}-{self.generation}-{filters}".encode()).hexdigest()
+        return f'W/"{tag}"'
@@ -2,13 +2,15 @@ import shutil
 from fastapi import FastAPI, APIRouter, Query, Body, Depends
 from fastapi.staticfiles import StaticFiles
 from fastapi_restful.openapi import simplify_operation_ids
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.exceptions import RequestValidationError, ValidationError, HTTPException
 from pydantic.main import BaseModel
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.requests import Request
-from sdk.fetcher.yt.api import Youtube
-from .models import Chapter, Grade, Board, Subject, GitOP, ResourceMetadata, ResourceLang
+from sdk.fetcher.yt.api import Youtube, AsyncYoutube
+from sdk.fetcher.yt.quota import QuotaExceeded, get_scheduler
+from .chapter_index import ChapterIndex
+from .models import Chapter, Grade, Board, Subject, GitOP, ResourceMetadata, ResourceLang, ResourceImport, ImportFormat
 import asyncpg
 from lynxfall.utils.fastapi import api_success, api_error
 from sdk.create_new import create_new
@@ -19,15 +21,17 @@ from ruamel.yaml import YAML
 from sdk import common, gen_info, compilestatic
 from pathlib import Path
 import os
+import asyncio
 import contextlib
 from io import StringIO
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from copy import deepcopy
 import orjson
 import uuid
+import csv
 import re
 
-key_data = common.load_yaml("data/core/internal_api.yaml")
+key_data = common.load_core("internal_api")
 
 nsc_regex ="^(?![0-9.-])(?!.*[0-9.-]$)(?!.*\d-)(?!.*-\d)[a-zA-Z0-9-]+$" # To reject all special characters other than numbers and hyphens
 
@@ -55,15 +59,23 @@ router = APIRouter(
     tags=["Internal"]
 )
 
+chapter_index = ChapterIndex()
+
 @app.on_event("startup")
 async def on_startup():
     app.state.db = await asyncpg.create_pool()
-    app.state.yt = Youtube()
+    app.state.yt = Youtube() # For the data build and scrapers
+    app.state.aioyt = AsyncYoutube() # For endpoints, does not block the event loop
     app.state.ipc_up = True # We use lots of code from Fates List, so we need to set these to True
     app.state.first_run = True
     app.state.gunicorn = False
     app.state.is_internal = True
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await app.state.aioyt.close()
+    app.state.yt.close()
+
 # Setup exception handling
 @app.exception_handler(403)
 @app.exception_handler(404)
@@ -144,6 +156,7 @@ def new_chapter(
     Creates a new chapter in the syllabus
     """
     rc, ctx = create_new(grade=grade.value, board=board.value.lower(), subject=subject.value.lower(), name=name, iname=iname)
+    chapter_index.invalidate()
     if rc:
         return api_error(rc)
     return api_success(ctx=ctx)
@@ -233,37 +246,21 @@ def edit_chapter_props(
     if study_time:
         data["study-time"] = study_time
     common.dump_yaml(info_yaml, data)
+    chapter_index.invalidate()
     return api_success()
 
 @router.get("/chapters", response_model=Chapter)
-def get_chapters(grade: int = None, board: str = None, subject: str = None, chapter: int = None):
-    chapters = []
-    for path in Path("data/grades").rglob("*/*/*"):
-        if not path.name.endswith("info.yaml"):
-            continue
-        _, _, _grade, _board, _subject, _chapter, _ = path.parts
-        if grade and str(grade) != _grade:
-            continue
-        elif board and board != _board:
-            continue
-        elif subject and subject != _subject:
-            continue
-        elif chapter and str(chapter) != _chapter:
-            continue
-        
-        try:
-            data = common.read_min(str(path).replace("grades", "build/grades", 1).replace("info.yaml", "info.lynx"))
-        except FileNotFoundError:
-            return api_error("You must perform atleast one data build before doing this")
-
-        try:
-            data["study_time"] = data["study-time"]
-            del data["study-time"]
-        except Exception:
-            pass
-
-        chapters.append(data)
+def get_chapters(request: Request, response: Response, grade: int = None, board: str = None, subject: str = None, chapter: int = None):
+    """Chapters of the live build, served from memory (see ChapterIndex). Supports If-None-Match"""
+    try:
+        chapters = chapter_index.query(grade, board, subject, chapter)
+    except FileNotFoundError:
+        return api_error("You must perform atleast one data build before doing this")
 
+    etag = chapter_index.etag(grade, board, subject, chapter)
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return {"chapters": chapters}
 
 @router.put("/topics")
@@ -343,6 +340,7 @@ def add_or_edit_topic(
             data["topics"][subtopic_parent]["subtopics"][topic_name_internal] = ext
     
     common.dump_yaml(info_yaml, data)
+    chapter_index.invalidate()
 
     try:
         mc_analyze = len(data["topics"].get("main", {}).get("subtopics", {}).values())
@@ -400,13 +398,152 @@ def change_topic_position(
             data["topics"][subtopic_parent]["subtopics"][topic_name_internal] = bak
     
     common.dump_yaml(info_yaml, data)
+    chapter_index.invalidate()
     return api_success()
 
 
+@router.get("/yt/quota")
+async def get_yt_quota():
+    """YouTube API quota used today (pacific time) by all clients"""
+    return api_success(**await asyncio.to_thread(get_scheduler().report), force_200=True)
+
+
+def resource_filters(
+    grade: Optional[Grade], 
+    board: Optional[Board], 
+    subject: Optional[Subject], 
+    chapter: Optional[int], 
+    resource_type: Optional[common.ResourceList]
+) -> Tuple[List[str], list]:
+    """Returns the WHERE conditions and their arguments for the set filters on topic_resources"""
+    conditions = []
+    args = []
+
+    def add(condition: str, value):
+        args.append(value)
+        conditions.append(condition.format(f"${len(args)}"))
+
+    if grade:
+        add("grade = {}", int(grade.value))
+    if board:
+        add("board = {}", board.value.lower())
+    if subject:
+        add("subject = {}", common.get_subject_name(grade, subject) if grade else subject.value.lower())
+    if chapter is not None:
+        add("chapter_num = {}", chapter)
+    if resource_type:
+        add("resource_type = {}", common.get_resource_by_name(resource_type.name).value)
+    return conditions, args
+
 @router.get("/topics/resources")
-async def get_resources():
-    return await app.state.db.fetch("SELECT * FROM topic_resources")
+async def get_resources(
+    response: Response,
+    grade: Optional[Grade] = None,
+    board: Optional[Board] = None,
+    subject: Optional[Subject] = None,
+    chapter: Optional[int] = Query(
+        None,
+        description="Chapter number"
+    ),
+    resource_type: Optional[common.ResourceList] = Query(
+        None,
+        description="Resource type"
+    ),
+    after: Optional[uuid.UUID] = Query(
+        None,
+        description="Only return resources after this resource id. Use the X-Next-After header of the previous page"
+    ),
+    limit: Optional[int] = Query(
+        None,
+        description="Maximum number of resources to return. Leave blank for all of them",
+        ge=1,
+        le=10000
+    ),
+    stream: bool = Query(
+        False,
+        description="Stream resources as newline delimited JSON as they are read from the database"
+    )
+):
+    """
+    Gets resources matching the given filters ordered by resource id
+
+    Pages are fetched by passing the last resource id of a page as after (keyset pagination). 
+    If there may be more resources, the X-Next-After header is set to the id to pass
+    """
+    conditions, args = resource_filters(grade, board, subject, chapter, resource_type)
+    if after:
+        args.append(after)
+        conditions.append(f"resource_id > ${len(args)}")
+
+    headers = {}
+    if stream and limit:
+        # Headers go out before the rows so find the last id of the page first. The page is then streamed 
+        # up to that id instead of with a limit, so rows added in between can't push any out of the page
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        next_after = await app.state.db.fetchval(
+            f"SELECT resource_id FROM topic_resources{where} ORDER BY resource_id OFFSET ${len(args) + 1} LIMIT 1",
+            *args, 
+            limit - 1
+        )
+        if next_after:
+            headers["X-Next-After"] = str(next_after)
+            args.append(next_after)
+            conditions.append(f"resource_id <= ${len(args)}")
+            limit = None
+
+    query = "SELECT * FROM topic_resources"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY resource_id"
+    if limit:
+        args.append(limit)
+        query += f" LIMIT ${len(args)}"
+
+    if stream:
+        async def stream_rows():
+            # Cursors need a transaction. Rows are prefetched in batches so memory use stays flat
+            async with app.state.db.acquire() as conn:
+                async with conn.transaction():
+                    async for row in conn.cursor(query, *args, prefetch=500):
+                        yield orjson.dumps(dict(row)) + b"\n"
+
+        return StreamingResponse(stream_rows(), media_type="application/x-ndjson", headers=headers)
+
+    rows = await app.state.db.fetch(query, *args)
+    if limit and len(rows) == limit:
+        response.headers["X-Next-After"] = str(rows[-1]["resource_id"])
+    return rows
+
+
+# Columns written by PUT /topics/resources and POST /topics/resources/bulk
+RESOURCE_COLUMNS = (
+    "grade", "board", "subject", "chapter_num", "chapter_iname", "topic_iname", "subtopic_parent", "resource_type", 
+    "resource_title", "resource_description", "resource_url", "resource_author", "resource_metadata", "resource_icon", "resource_lang"
+)
 
+# Metadata is merged into that of an existing resource (new keys win) and its resource_id is kept
+RESOURCE_UPSERT = """ON CONFLICT (grade, board, subject, chapter_iname, topic_iname, subtopic_parent, resource_url) DO UPDATE SET
+    chapter_num = EXCLUDED.chapter_num, resource_type = EXCLUDED.resource_type, resource_title = EXCLUDED.resource_title,
+    resource_description = EXCLUDED.resource_description, resource_author = EXCLUDED.resource_author,
+    resource_metadata = topic_resources.resource_metadata || EXCLUDED.resource_metadata,
+    resource_icon = EXCLUDED.resource_icon, resource_lang = EXCLUDED.resource_lang"""
+
+def youtube_video_id(url: str) -> Optional[str]:
+    if "youtube.com" in url and "?v=" in url:
+        return url.split("?v=")[1].split("&")[0]
+    return None
+
+def enrich_from_youtube(video, resource_metadata: dict, res_meta: dict) -> Tuple[str, str, str]:
+    """Returns the title, author and icon of a video and adds its url and view count to res_meta"""
+    title = author = icon = None
+    for video_item in video.loop():
+        title = video_item["snippet"]["title"]
+        author = video_item["snippet"]["channelTitle"]
+        icon = video_item["snippet"]["thumbnails"]["default"]["url"]
+        res_meta["yt_video_url"] = video_item["id"]
+        if not resource_metadata.get("view_count"):
+            res_meta["view_count"] = int(video_item["statistics"]["viewCount"])
+    return title, author, icon
 
 @router.put("/topics/resources")
 async def new_resource(
@@ -458,7 +595,6 @@ async def new_resource(
     subject = common.get_subject_name(grade, subject)
 
     resource_metadata = resource_metadata.resource_metadata
-    repaired = False
     info_yaml = Path("data/grades") / str(grade.value) / board.value.lower() / subject / str(chapter) / "info.yaml"
     if not info_yaml.exists():
         return api_error("Chapter does not exist!", status_code=404)
@@ -479,60 +615,17 @@ async def new_resource(
     grade = int(grade.value)
     board = board.value.lower()
 
-    check = await app.state.db.fetch(
-        "SELECT resource_id AS id, resource_metadata FROM topic_resources WHERE chapter_iname = $1 AND topic_iname = $2 AND subtopic_parent = $3 AND resource_url = $4 AND grade = $5 AND board = $6 AND subject = $7",
-        chapter_iname,
-        topic_name_internal,
-        subtopic_parent,
-        resource_url,
-        grade,
-        board,
-        subject
-    )
-    print(check)
-    if check and len(check) > 1:
-        # Corrupt resource alert
-        repaired = True
-        id = check[0]["id"] # Remove all but first resource
-        await app.state.db.execute(
-            "DELETE FROM topic_resources WHERE chapter_iname = $1 AND topic_iname = $2 AND subtopic_parent = $3 AND resource_url = $4 AND grade = $5 AND board = $6 AND subject = $7",
-            chapter_iname,
-            topic_name_internal,
-            subtopic_parent,
-            resource_url,
-            grade,
-            board,
-            subject
-        )
-        res_meta = orjson.loads(check[0]["resource_metadata"])
-    elif check and len(check) == 1:
-        # Delete old preserving metadata
-        id = check[0]["id"]
-        await app.state.db.execute(
-            "DELETE FROM topic_resources WHERE chapter_iname = $1 AND topic_iname = $2 AND subtopic_parent = $3 AND resource_url = $4 AND grade = $5 AND board = $6 AND subject = $7",
-            chapter_iname,
-            topic_name_internal,
-            subtopic_parent,
-            resource_url,
-            grade,
-            board,
-            subject
-        )
-        res_meta = orjson.loads(check[0]["resource_metadata"])
-    else:
-        res_meta = {}
-        id = str(uuid.uuid4())
-    
-    if "youtube.com" in resource_url and "?v=" in resource_url:
-        video_id = resource_url.split("?v=")[1].split("&")[0] # Extract video id
-        video = app.state.yt.get_video(video_id)
-        for video_item in video.loop():
-            resource_title = resource_title or video_item["snippet"]["title"]
-            resource_author = resource_author or video_item["snippet"]["channelTitle"]
-            resource_icon = resource_icon or video_item["snippet"]["thumbnails"]["default"]["url"]
-            res_meta["yt_video_url"] = video_id
-            if not resource_metadata.get("view_count"):
-                res_meta["view_count"] = int(video_item["statistics"]["viewCount"])
+    res_meta = {}
+    video_id = youtube_video_id(resource_url)
+    if video_id:
+        try:
+            video = await app.state.aioyt.get_video(video_id)
+        except QuotaExceeded as exc:
+            return api_error(str(exc))
+        title, author, icon = enrich_from_youtube(video, resource_metadata, res_meta)
+        resource_title = resource_title or title
+        resource_author = resource_author or author
+        resource_icon = resource_icon or icon
     
     res_meta |= resource_metadata
     
@@ -543,11 +636,10 @@ async def new_resource(
     elif not resource_icon:
         return api_error("You must set resource_icon")
 
-    id = await app.state.db.fetchval(
-        """INSERT INTO topic_resources (grade, board, subject, chapter_num, chapter_iname, topic_iname, subtopic_parent,
-        resource_type, resource_title, resource_description, resource_url, resource_author, resource_metadata, resource_id,
-        resource_icon, resource_lang) VALUES (
-        $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16) RETURNING resource_id""",
+    row = await app.state.db.fetchrow(
+        f"""INSERT INTO topic_resources ({", ".join(RESOURCE_COLUMNS)}) VALUES (
+        $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15) {RESOURCE_UPSERT}
+        RETURNING resource_id AS id, xmax = 0 AS created""",
         grade,
         board,
         subject,
@@ -561,12 +653,182 @@ async def new_resource(
         resource_url,
         resource_author,
         orjson.dumps(res_meta).decode("utf-8"),
-        id,
         resource_icon,
         resource_lang.name
     )
 
-    return api_success(repaired=repaired, id=str(id), force_200=True)
+    return api_success(id=str(row["id"]), created=row["created"], force_200=True)
+
+
+def read_resource_import(data: str, format: ImportFormat) -> List[dict]:
+    """Splits a bulk import into rows. Rows that can't be parsed are an exception instead"""
+    rows = []
+    if format == ImportFormat.csv:
+        for row in csv.DictReader(StringIO(data)):
+            if None in row:
+                rows.append(ValueError("Row has more cells than the header"))
+                continue
+            # Empty cells use the default
+            rows.append({k.strip(): v for k, v in row.items() if v not in ("", None)})
+        return rows
+
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            row = orjson.loads(line)
+        except orjson.JSONDecodeError as exc:
+            rows.append(exc)
+            continue
+        rows.append(row if isinstance(row, dict) else ValueError("Row must be a JSON object"))
+    return rows
+
+@router.post(
+    "/topics/resources/bulk",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "text/csv": {
+                    "schema": {"type": "string"}
+                },
+                "application/x-ndjson": {
+                    "schema": {"type": "string"}
+                }
+            }
+        }
+    }
+)
+async def bulk_import_resources(
+    request: Request,
+    grade: Grade,
+    board: Board,
+    subject: Subject,
+    format: ImportFormat = Query(
+        ImportFormat.csv,
+        description="Format of the body. CSV needs a header row with the field names"
+    ),
+    pretend: bool = Query(
+        False,
+        description="Only check the rows and look up their videos, nothing is written"
+    )
+):
+    """
+    Creates or edits many resources of a subject at once
+
+    Every row has the fields of PUT /topics/resources (chapter, topic_name_internal, subtopic_parent, resource_type, resource_url, 
+    resource_title, resource_description, resource_icon, resource_author, resource_lang and resource_metadata which is a JSON object).
+    YouTube videos are looked up in batches and every valid row is written in one transaction. Returns what happened to each row
+    """
+    subject = common.get_subject_name(grade, subject)
+    grade = int(grade.value)
+    board = board.value.lower()
+
+    chapter_listing = Path("data/build/grades") / str(grade) / board / subject / "chapter_list.lynx"
+    if not chapter_listing.exists():
+        return api_error("You must perform atleast one data build before doing this")
+    chapter_listing_json = common.read_min(chapter_listing)
+
+    try:
+        # utf-8-sig drops the BOM spreadsheet exports start with, which would otherwise end up in the first header
+        data = (await request.body()).decode("utf-8-sig")
+    except UnicodeDecodeError as exc:
+        return api_error(f"The import must be UTF-8: {exc}")
+    try:
+        parsed = read_resource_import(data, format)
+    except csv.Error as exc:
+        return api_error(f"Invalid CSV: {exc}")
+
+    report = []
+    rows = {} # Row number to (resource, chapter_iname) of valid rows
+    seen = {}
+    for n, fields in enumerate(parsed, start=1):
+        report.append({"row": n, "status": "error"})
+        try:
+            if isinstance(fields, Exception):
+                raise fields
+            resource = ResourceImport(**fields)
+            if not re.match(nsc_regex, resource.topic_name_internal) or len(resource.topic_name_internal) < 2:
+                raise ValueError("Invalid topic_name_internal")
+            if resource.topic_name_internal == "main" and resource.subtopic_parent == "main":
+                raise ValueError("Illegal topic_name_internal and subtopic_parent!")
+            info_yaml = Path("data/grades") / str(grade) / board / subject / str(resource.chapter) / "info.yaml"
+            if not info_yaml.exists() or resource.chapter not in chapter_listing_json:
+                raise ValueError("Chapter does not exist!")
+        except ValueError as exc:
+            report[-1]["error"] = str(exc)
+            continue
+
+        chapter_iname = chapter_listing_json[resource.chapter]["iname"]
+        identity = (chapter_iname, resource.topic_name_internal, resource.subtopic_parent, resource.resource_url)
+        if identity in seen:
+            report[-1]["error"] = f"Same resource as row {seen[identity]}"
+            continue
+        seen[identity] = n
+        rows[n] = (resource, chapter_iname)
+
+    video_ids = {n: youtube_video_id(resource.resource_url) for n, (resource, _) in rows.items()}
+    try:
+        videos = await app.state.aioyt.get_videos([video_id for video_id in video_ids.values() if video_id])
+    except QuotaExceeded as exc:
+        return api_error(str(exc))
+
+    records = {}
+    for n, (resource, chapter_iname) in rows.items():
+        res_meta = {}
+        video = videos.get(video_ids[n])
+        if video:
+            title, author, icon = enrich_from_youtube(video, resource.resource_metadata, res_meta)
+            resource.resource_title = resource.resource_title or title
+            resource.resource_author = resource.resource_author or author
+            resource.resource_icon = resource.resource_icon or icon
+        res_meta |= resource.resource_metadata
+
+        missing = [f for f in ("resource_author", "resource_title", "resource_icon") if not getattr(resource, f)]
+        if missing:
+            report[n-1]["error"] = f"You must set {', '.join(missing)}"
+            continue
+
+        # In the order of RESOURCE_COLUMNS
+        records[n] = (
+            grade,
+            board,
+            subject,
+            resource.chapter,
+            chapter_iname,
+            resource.topic_name_internal,
+            resource.subtopic_parent,
+            common.get_resource_by_name(resource.resource_type.name).value,
+            resource.resource_title,
+            resource.resource_description,
+            resource.resource_url,
+            resource.resource_author,
+            orjson.dumps(res_meta).decode("utf-8"),
+            resource.resource_icon,
+            resource.resource_lang.name
+        )
+
+    if pretend:
+        for n in records:
+            report[n-1]["status"] = "valid"
+    elif records:
+        # COPY can't handle conflicts so rows are copied into a temporary table and upserted from there in one statement
+        columns = ", ".join(RESOURCE_COLUMNS)
+        async with app.state.db.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("CREATE TEMPORARY TABLE resource_import (LIKE topic_resources INCLUDING DEFAULTS) ON COMMIT DROP")
+                await conn.copy_records_to_table("resource_import", records=list(records.values()), columns=RESOURCE_COLUMNS)
+                written = await conn.fetch(
+                    f"""INSERT INTO topic_resources ({columns}) SELECT {columns} FROM resource_import {RESOURCE_UPSERT}
+                    RETURNING resource_id AS id, xmax = 0 AS created, chapter_iname, topic_iname, subtopic_parent, resource_url"""
+                )
+
+        for row in written:
+            n = seen[(row["chapter_iname"], row["topic_iname"], row["subtopic_parent"], row["resource_url"])]
+            report[n-1] |= {"status": "created" if row["created"] else "updated", "id": str(row["id"])}
+
+    counts = {status: sum(1 for r in report if r["status"] == status) for status in ("created", "updated", "valid", "error")}
+    return api_success(rows=report, **counts, force_200=True)
 
 
 @router.delete("/topics/resources")
@@ -597,7 +859,31 @@ async def delete_resource(
 
 
 @router.post("/data/build")
-async def build_data():
+async def build_data(
+    incremental: bool = Query(
+        False,
+        description="Only rebuild chapters whose info.yaml, resources or templates changed since the last build"
+    ),
+    concurrency: int = Query(
+        None,
+        description="How many subjects to build at the same time. Defaults to the database pool size",
+        ge=1
+    ),
+    processes: int = Query(
+        None,
+        description="Build every grade in a separate worker process using up to this many processes. Leave blank to build in the server process",
+        ge=1
+    ),
+    keep: int = Query(
+        1,
+        description="How many previous builds to keep around for rollbacks",
+        ge=0
+    ),
+    shard_resources: bool = Query(
+        False,
+        description="Write the raw resource dump as one keystone/resources-{grade}.lynx per grade instead of one keystone/resources.lynx"
+    )
+):
     """
     Warning: May hang the server
     
@@ -606,13 +892,25 @@ async def build_data():
     out = StringIO()
     err = StringIO()
     with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
-        await gen_info.gen_info(app.state.db, app.state.yt)
+        try:
+            await gen_info.gen_info(app.state.db, app.state.yt, incremental=incremental, concurrency=concurrency, processes=processes, keep=keep, shard_resources=shard_resources)
+        finally:
+            chapter_index.invalidate()
 
     out.seek(0)
     err.seek(0)
 
     return HTMLResponse(f"{out.read()}\n\nErrors:\n{err.read()}")
 
+@router.post("/data/build/rollback")
+def rollback_data_build():
+    """Makes the build before the live one live again"""
+    build = gen_info.rollback_build()
+    chapter_index.invalidate()
+    if not build:
+        return api_error("There is no previous build to roll back to")
+    return api_success(build=build)
+
 @router.post("/compilestatic")
 def compile_static():
     """Warning: May hang the server"""
@@ -650,6 +948,7 @@ def git(commitmsg: str = "Some fixes to improve stability", op: GitOP = GitOP.pu
     out, err = f(out, err)
     os.chdir("data")
     out, err = f(out, err)
+    chapter_index.invalidate()
     
     return HTMLResponse(f"{out}\n{err}")
 
@@ -678,6 +977,7 @@ async def delete_chapter(
     chapter_iname = chapter_listing_json[chapter]["iname"]
 
     shutil.rmtree(str(chapter_dir))
+    chapter_index.invalidate()
     await app.state.db.execute(
         "DELETE FROM topic_resources WHERE chapter_iname = $1",
         chapter_iname
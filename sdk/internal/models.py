@@ -1,9 +1,10 @@
 from __future__ import annotations
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 from typing import Any, List, Optional, Dict
 from enum import IntEnum, Enum
 from sdk import common
 from sdk.common import Resource
+import orjson
 
 # For VSCode
 if True is False:
@@ -24,17 +25,21 @@ class ResourceLang(Enum):
     hi = "Hindi"
 
 Board = Enum('Board', {
-    k: k for k in (common.load_yaml("data/core/boards.yaml"))
+    k: k for k in (common.load_core("boards"))
 })
 
 Subject = Enum('Subject', {
-    k: k.title() for k in (common.load_yaml("data/core/subjects.yaml").keys())
+    k: k.title() for k in (common.load_core("subjects").keys())
 })
 
 class GitOP(str, Enum):
     push = "push"
     pull = "pull"
 
+class ImportFormat(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
 
 class APIResponse(BaseModel):
     done: bool = True
@@ -61,4 +66,32 @@ class Chapter(APIResponse):
     chapters: List[ChapterData]
 
 class ResourceMetadata(BaseModel):
-    resource_metadata: Dict[str, Any] = {}
\ No newline at end of file
+    resource_metadata: Dict[str, Any] = {}
+
+class ResourceImport(BaseModel):
+    """A row of POST /topics/resources/bulk, the fields are the same as those of PUT /topics/resources"""
+    chapter: int
+    topic_name_internal: str
+    subtopic_parent: str = ""
+    resource_type: common.ResourceList
+    resource_url: str
+    resource_title: Optional[str] = None
+    resource_description: Optional[str] = None
+    resource_icon: Optional[str] = None
+    resource_author: Optional[str] = None
+    resource_lang: ResourceLang = ResourceLang.en
+    resource_metadata: Dict[str, Any] = {}
+
+    @validator("resource_type", "resource_lang", pre=True)
+    def enum_by_name(cls, v, field):
+        # Allow whiteboard and en as well as Whiteboard and English
+        if isinstance(v, str) and v in field.type_.__members__:
+            return field.type_[v]
+        return v
+
+    @validator("resource_metadata", pre=True)
+    def metadata_from_json(cls, v):
+        # CSV cells are JSON strings
+        if isinstance(v, str):
+            return orjson.loads(v)
+        return v
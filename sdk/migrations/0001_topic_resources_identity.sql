@@ -0,0 +1,26 @@
+-- One off migration for databases made before topic_resources had a unique identity
+-- Run with \i sdk/migrations/0001_topic_resources_identity.sql before loading sdk/schema.sql on such a database
+--
+-- Of each set of duplicate resources (same grade, board, subject, chapter_iname, topic_iname, subtopic_parent
+-- and resource_url), the one kept is chosen by this rule (topic_resources has no edit time to go by):
+--   1. an enabled row over a disabled one
+--   2. then the most filled in row, by number of resource_metadata keys and then having a description
+--   3. then the lowest resource_id, so running this again on a restored backup keeps the same row
+BEGIN;
+
+DELETE FROM topic_resources WHERE ctid IN (
+    SELECT ctid FROM (
+        SELECT ctid, ROW_NUMBER() OVER (
+            PARTITION BY grade, board, subject, chapter_iname, topic_iname, subtopic_parent, resource_url
+            ORDER BY
+                disabled IS TRUE,
+                (SELECT COUNT(*) FROM jsonb_object_keys(CASE WHEN jsonb_typeof(resource_metadata) = 'object' THEN resource_metadata ELSE '{}' END)) DESC,
+                resource_description IS NULL,
+                resource_id
+        ) AS n FROM topic_resources
+    ) ranked WHERE n > 1
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS topic_resources_identity ON topic_resources (grade, board, subject, chapter_iname, topic_iname, subtopic_parent, resource_url);
+
+COMMIT;
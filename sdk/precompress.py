@@ -0,0 +1,106 @@
+"""Precompressed sidecar files for build artifacts so nginx can serve them with gzip_static/brotli_static"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Files that get sidecars
+EXTENSIONS = (".lynx", ".snowfall")
+
+def _gzip(data: bytes) -> bytes:
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def _brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=11)
+
+def _zstd(data: bytes) -> bytes:
+    # Compressors are not thread safe so make one per call
+    return zstandard.ZstdCompressor(level=22).compress(data)
+
+def get_encoders() -> Dict[str, Callable[[bytes], bytes]]:
+    """Returns a map of sidecar suffix to compressor for every compressor that is installed"""
+    encoders = {".gz": _gzip}
+    if brotli:
+        encoders[".br"] = _brotli
+    else:
+        print("WARNING: brotli is not installed, not making .br sidecars")
+    if zstandard:
+        encoders[".zst"] = _zstd
+    else:
+        print("WARNING: zstandard is not installed, not making .zst sidecars")
+    return encoders
+
+def _compress_file(path: Path, encoders: Dict[str, Callable[[bytes], bytes]]) -> Tuple[int, Dict[str, int], int]:
+    """Makes all out of date sidecars of a file. Returns the raw size, the size of each sidecar and how many were made"""
+    raw_size = path.stat().st_size
+    mtime = path.stat().st_mtime_ns
+    data = None
+    sizes = {}
+    made = 0
+    for suffix, encoder in encoders.items():
+        sidecar = Path(f"{path}{suffix}")
+        if sidecar.exists() and sidecar.stat().st_mtime_ns >= mtime:
+            # Unchanged since the sidecar was made
+            sizes[suffix] = sidecar.stat().st_size
+            continue
+        if data is None:
+            data = path.read_bytes()
+        compressed = encoder(data)
+        tmp = Path(f"{sidecar}.tmp")
+        tmp.write_bytes(compressed)
+        os.replace(tmp, sidecar)
+        sizes[suffix] = len(compressed)
+        made += 1
+    return raw_size, sizes, made
+
+def remove_orphans(root: Path, suffixes: List[str]):
+    """Removes sidecars whose file no longer exists"""
+    for suffix in (".gz", ".br", ".zst"):
+        for sidecar in root.rglob(f"*{suffix}"):
+            if not sidecar.with_suffix("").exists() or suffix not in suffixes:
+                sidecar.unlink(missing_ok=True)
+
+def precompress(root: str, workers: int = None) -> dict:
+    """
+    Makes gzip, brotli and zstd sidecars (at their maximum levels) of every build artifact in root
+
+    Only files that changed since their sidecars were made are compressed. Returns a report
+    with the raw and compressed byte totals of every encoding
+    """
+    root = Path(root)
+    encoders = get_encoders()
+    remove_orphans(root, list(encoders.keys()))
+
+    files = [path for path in root.rglob("*") if path.is_file() and path.suffix in EXTENSIONS]
+
+    report = {
+        "files": len(files),
+        "compressed_files": 0,
+        "raw_bytes": 0,
+        "encodings": {suffix.lstrip("."): 0 for suffix in encoders.keys()}
+    }
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for raw_size, sizes, made in executor.map(lambda path: _compress_file(path, encoders), files):
+            report["raw_bytes"] += raw_size
+            report["compressed_files"] += made
+            for suffix, size in sizes.items():
+                report["encodings"][suffix.lstrip(".")] += size
+
+    print(f"Precompressed {report['compressed_files']} sidecars for {report['files']} files ({report['raw_bytes']} bytes raw)")
+    for encoding, size in report["encodings"].items():
+        ratio = (size / report["raw_bytes"] * 100) if report["raw_bytes"] else 0
+        print(f"{encoding}: {size} bytes ({ratio:.1f}% of raw)")
+
+    return report
@@ -21,6 +21,14 @@ CREATE TABLE IF NOT EXISTS topic_resources (
     disabled BOOLEAN DEFAULT FALSE -- Whether the resource is disabled or not
 );
 
+-- For keyset pagination and filtering of GET /topics/resources
+CREATE INDEX IF NOT EXISTS topic_resources_resource_id ON topic_resources (resource_id);
+CREATE INDEX IF NOT EXISTS topic_resources_chapter ON topic_resources (grade, board, subject, chapter_num);
+
+-- A resource is unique per url in a subtopic, PUT /topics/resources upserts on this. Older databases
+-- may have duplicates, run sdk/migrations/0001_topic_resources_identity.sql on them first
+CREATE UNIQUE INDEX IF NOT EXISTS topic_resources_identity ON topic_resources (grade, board, subject, chapter_iname, topic_iname, subtopic_parent, resource_url);
+
 CREATE TABLE IF NOT EXISTS users (
     username TEXT NOT NULL,
     user_id UUID NOT NULL DEFAULT uuid_generate_v4(),
@@ -1,62 +1,174 @@
-from typing import Callable
+"""Async crawler that gets the title (and link) of non youtube resource pages"""
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
 from bs4 import BeautifulSoup
-import requests
 from sdk import common
 from selenium import webdriver
-from pyvirtualdisplay import Display
-from pyvirtualdisplay.abstractdisplay import XStartError
 from pathlib import Path
-import orjson
+import aiohttp
+import asyncio
+import hashlib
 import os
 
-started_display = False
-display = None
-
-def prepare():
-    display = Display(visible=0, size=(800, 600))
-    try:
-        display.start()
-        started_display = True
-    except XStartError:
-        pass
-    
-    return webdriver.Chrome()
-
-def page_kill(session):
-    session.close()
-    if started_display:
-        display.stop()
-
-
-def get_video_with_js(session, url: str) -> dict:
-    cache = Path("tmpstor") / f"url-{url}-js".replace("/", "@").replace(".", "*")
-    cache = cache.with_suffix(".min.json")
-    if not cache.exists():
-        print(f"Selenium scrape triggered on {url}")
-        session.get(url)
-        data = {"title": session.title, "link": url}
-        with cache.open("w") as cache_fp:
-            common.write_min_json(data, cache_fp)
-        return data
-    else:
+class Crawler():
+    """
+    Crawls pages with pooled keep-alive connections and at most per_host requests to a host at a time
+
+    Pages that need JS are loaded in a pool of up to browsers headless Chrome sessions. Browsers are only
+    started when a JS page is first crawled and are reused after that. Results are cached in cache_dir
+    under a hash of the url
+    """
+    def __init__(self, per_host: int = 4, max_connections: int = 32, browsers: int = 2, cache_dir: str = "tmpstor/crawl"):
+        self.per_host = per_host
+        self.max_connections = max_connections
+        self.browsers = browsers
+        self.cache_dir = Path(cache_dir)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.host_limits: Dict[str, asyncio.Semaphore] = {}
+        self.browser_slots: Optional[asyncio.Semaphore] = None # One per browser that is started or may be started
+        self.idle_browsers: List[webdriver.Chrome] = []
+        self.all_browsers: List[webdriver.Chrome] = []
+
+    def _cache_path(self, url: str, mode: str) -> Path:
+        digest = hashlib.sha256(f"{mode}:{url}".encode()).hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest}.lynx"
+
+    def _fcache(self, url: str, mode: str) -> Optional[dict]:
+        cache = self._cache_path(url, mode)
+        if not cache.exists():
+            return None
         if os.environ.get("DEBUG"):
             print(f"Using cached resource {cache}")
-        with cache.open() as cache_fp:
-            return orjson.loads(cache_fp.read())
+        return common.read_min(cache)
+
+    def _wcache(self, url: str, mode: str, data: dict):
+        cache = self._cache_path(url, mode)
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with cache.open("wb") as cache_fp:
+            common.write_min(data, cache_fp, no_debug=True)
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self.host_limits[host]
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if not self.session or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=60),
+                raise_for_status=True
+            )
+        return self.session
+
+    async def get_video_bs4(self, url: str) -> dict:
+        data = self._fcache(url, "bs4")
+        if data:
+            return data
 
-def get_video_bs4(url: str) -> dict:
-    cache = Path("tmpstor") / f"url-{url}-bs4".replace("/", "@").replace(".", "*")
-    cache = cache.with_suffix(".min.json")
-    if not cache.exists():
         print(f"BS4 scrape triggered on {url}")
-        html = requests.get(url).text
-        soup = BeautifulSoup(html, 'html.parser')
-        data = {"title": soup.title.string, "link": url}
-        with cache.open("w") as cache_fp:
-            common.write_min_json(data, cache_fp)
+        session = await self._get_session()
+        async with self._host_limit(url):
+            async with session.get(url) as res:
+                html = await res.text()
+
+        soup = await asyncio.to_thread(BeautifulSoup, html, "html.parser")
+        data = {"title": soup.title.string if soup.title else None, "link": url}
+        self._wcache(url, "bs4", data)
         return data
-    else:
-        if os.environ.get("DEBUG"):
-            print(f"Using cached resource {cache}")
-        with cache.open() as cache_fp:
-            return orjson.loads(cache_fp.read())
+
+    def _start_browser(self) -> webdriver.Chrome:
+        options = webdriver.ChromeOptions()
+        options.add_argument("--headless=new")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--no-sandbox")
+        return webdriver.Chrome(options=options)
+
+    async def _get_browser(self) -> webdriver.Chrome:
+        """Takes an idle browser or starts a new one once a slot is free. Give it back with _release_browser or _discard_browser"""
+        if not self.browser_slots:
+            self.browser_slots = asyncio.Semaphore(self.browsers)
+        await self.browser_slots.acquire()
+        if self.idle_browsers:
+            return self.idle_browsers.pop()
+        try:
+            browser = await asyncio.to_thread(self._start_browser)
+        except BaseException:
+            self.browser_slots.release()
+            raise
+        self.all_browsers.append(browser)
+        return browser
+
+    def _release_browser(self, browser: webdriver.Chrome):
+        self.idle_browsers.append(browser)
+        self.browser_slots.release()
+
+    async def _discard_browser(self, browser: webdriver.Chrome):
+        """Quits a browser, freeing its slot so a waiting crawl can start a new one"""
+        self.all_browsers.remove(browser)
+        self.browser_slots.release()
+        try:
+            await asyncio.to_thread(browser.quit)
+        except Exception:
+            pass
+
+    async def get_video_with_js(self, url: str) -> dict:
+        data = self._fcache(url, "js")
+        if data:
+            return data
+
+        print(f"Selenium scrape triggered on {url}")
+        async with self._host_limit(url):
+            browser = await self._get_browser()
+            try:
+                await asyncio.to_thread(browser.get, url)
+                data = {"title": browser.title, "link": url}
+            except BaseException:
+                # The browser may be in a bad state so start a new one next time
+                await self._discard_browser(browser)
+                raise
+            self._release_browser(browser)
+
+        self._wcache(url, "js", data)
+        return data
+
+    async def crawl(self, urls: List[str], js: bool = False) -> Dict[str, Optional[dict]]:
+        """Crawls many urls at once. Urls that fail are None"""
+        get = self.get_video_with_js if js else self.get_video_bs4
+        results = await asyncio.gather(*[get(url) for url in urls], return_exceptions=True)
+        crawled = {}
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                print(f"WARNING: Could not crawl {url}: {result}")
+                result = None
+            crawled[url] = result
+        return crawled
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+        browsers = self.all_browsers
+        self.all_browsers = []
+        self.idle_browsers = []
+        self.browser_slots = None
+        for browser in browsers:
+            try:
+                await asyncio.to_thread(browser.quit)
+            except Exception:
+                pass
+
+crawler: Optional[Crawler] = None
+
+def get_crawler() -> Crawler:
+    """The crawler of the build. Nothing is started until something is crawled"""
+    global crawler
+    if not crawler:
+        crawler = Crawler()
+    return crawler
+
+async def close_crawler():
+    global crawler
+    if crawler:
+        await crawler.close()
+        crawler = None